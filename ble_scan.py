@@ -0,0 +1,147 @@
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/micropython_aioble_examples
+#
+# One scan shared by the codes finding their peripherals (hr_read.py, hioki_z3210.py and the client of nus_modem_full_ver).
+#
+# aioble scans one at a time, and each code used to run a scan of its own and to call name()/services() of every result,
+# which decode the advertising data again on each call and on each report of the same device.  Here, a task scans while
+# anyone waits in find(); the data of a device are decoded only when they change, and the devices are kept by the address
+# in a small LRU with their RSSI and the time last seen.  Several find() of different names, services or peers wait
+# in the same scan, and a device seen recently is returned without scanning.  Call shared.reset() after asyncio.run(),
+# as the scan task does not survive the loop (e.g. asyncio.new_event_loop()) while find() would still count on it.
+
+from micropython import const
+
+import asyncio
+import aioble
+import time
+from collections import OrderedDict
+
+_SCAN_WINDOW_MS = const(1_000) # The scan is started again by this while anyone waits (a connection cancels the scan).
+_N_DEVICES = const(16) # Devices kept in the LRU.
+_FRESH_MS = const(10_000) # find() returns a device seen this recently without scanning.
+
+
+class Seen: # A device in the LRU; its advertising data are decoded only when they change.
+    def __init__(self, device):
+        self.device = device
+        self.adv_data = None
+        self.resp_data = None
+        self.name = None
+        self.services = ()
+        self.rssi = 0
+        self.ticks_ms = 0
+
+    def update(self, result): # True if the data were decoded.
+        self.rssi = result.rssi
+        self.ticks_ms = time.ticks_ms()
+        if result.adv_data == self.adv_data and result.resp_data == self.resp_data:
+            return False
+        self.adv_data = result.adv_data
+        self.resp_data = result.resp_data
+        self.name = result.name()
+        self.services = tuple(result.services())
+        return True
+
+    def matches(self, name, exact, service, peer): # The name (or its start), service advertised, and/or the peer.
+        return ((name is None or self.name is not None and (self.name == name if exact else self.name.startswith(name)))
+            and (service is None or service in self.services)
+            and (peer is None or self.device == peer)) # The type and the bytes of the address, by aioble.Device.
+
+
+class _Waiter:
+    def __init__(self, name, exact, service, peer):
+        self.name = name
+        self.exact = exact
+        self.service = service
+        self.peer = peer
+        self.event = asyncio.Event()
+        self.device = None
+
+
+class ScanService:
+    def __init__(self, n_devices=_N_DEVICES):
+        self.n_devices = n_devices
+        self.seen = OrderedDict() # Seen by the address; the least recent first.
+        self.waiters = []
+        self.task = None
+        self.holds = 0 # While connecting; see hold().
+        self.released = asyncio.Event()
+        self.results = 0 # Scan results, and those decoded; the rest were reports of the same data.
+        self.decoded = 0
+
+    async def find(self, name=None, service=None, peer=None, timeout_ms=5_000, max_age_ms=_FRESH_MS, exact=False):
+        # The device of the name (all of it if exact, otherwise its start), service and/or equal to peer (aioble.Device of
+        # a known address); None if not in time.
+        device = None
+        for seen in self.seen.values(): # The most recent one of those matching.
+            if seen.matches(name, exact, service, peer) and time.ticks_diff(time.ticks_ms(), seen.ticks_ms) < max_age_ms:
+                device = seen.device
+        if device:
+            return device
+        waiter = _Waiter(name, exact, service, peer)
+        self.waiters.append(waiter)
+        if self.task is None:
+            self.task = asyncio.create_task(self.scan())
+        try:
+            await asyncio.wait_for_ms(waiter.event.wait(), timeout_ms)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        return waiter.device
+
+    def hold(self): # Before connecting; a connection cancels the scan, which is not started again until release().
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+        if not self.holds:
+            self.released.set()
+
+    def reset(self): # After asyncio.run() returned; a scan task left in the old loop is cancelled and forgotten.
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+        self.waiters = []
+        self.holds = 0
+        self.released = asyncio.Event()
+
+    async def scan(self): # While anyone waits.
+        try:
+            while self.waiters:
+                if self.holds:
+                    self.released.clear()
+                    await self.released.wait()
+                    continue
+                try:
+                    # Active mode, with very low interval/window (to maximise detection rate).
+                    async with aioble.scan(_SCAN_WINDOW_MS, interval_us=30000, window_us=30000, active=True) as scanner:
+                        async for result in scanner:
+                            self.on_result(result)
+                            if not self.waiters:
+                                break
+                except OSError: # e.g. the stack is busy in connecting.
+                    await asyncio.sleep_ms(100)
+        finally:
+            if self.task is asyncio.current_task(): # Not the one started after reset().
+                self.task = None
+
+    def on_result(self, result):
+        self.results += 1
+        addr = result.device.addr
+        if (seen := self.seen.pop(addr, None)) is None:
+            if len(self.seen) >= self.n_devices:
+                del self.seen[next(iter(self.seen))] # The least recent one.
+            seen = Seen(result.device)
+        self.seen[addr] = seen # As the most recent one.
+        if seen.update(result):
+            self.decoded += 1
+        for waiter in [w for w in self.waiters if seen.matches(w.name, w.exact, w.service, w.peer)]:
+            waiter.device = seen.device
+            self.waiters.remove(waiter)
+            waiter.event.set()
+
+
+shared = ScanService() # Used by all of the codes in a program.
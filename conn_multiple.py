@@ -2,12 +2,16 @@ import sys
 
 sys.path.append('')
 
+from micropython import const
+
 import asyncio
 import aioble
 import bluetooth
 import machine
 import time
 
+import ble_scan
+
 # Constants and global variables
 address_hr = 'd8:75:ba:xx:yy:zz'
 address_dt4261 = 'a4:9e:69:xx:yy:zz'
@@ -18,115 +22,113 @@ _HEART_RATE_CHARACTERISTIC_UUID = bluetooth.UUID(0x2a37)
 _Z3210_UNKNOWN2_UUID = bluetooth.UUID('275ce3d8-b906-4475-8dd7-76af0db742bf')
 _Z3210_UNKNOWN2_CHAR1_UUID = bluetooth.UUID('78b028ce-affd-4967-ab9e-dc336c8c94e7') # This is used for communication.
 
-hr_task = dt4261_task = None
-hr_active = dt4261_active = False # Connection state
+_MAX_CONNECTIONS = const(3) # As CONFIG_BTDM_CTRL_BLE_MAX_CONN of the stack (see README).
+_CONNECT_TIMEOUT_MS = const(5_000)
+# A device is looked for in the shared scan for _FIND_MS; if not found or not connected, its task waits without scanning
+# by the backoff, doubled on each failure from _BACKOFF_MIN_MS up to _BACKOFF_MAX_MS.  At the maximum, a device not
+# found is connected to directly (e.g. one not seen by the scan), as before the scan was shared.
+_FIND_MS = const(2_000)
+_BACKOFF_MIN_MS = const(1_000)
+_BACKOFF_MAX_MS = const(60_000)
+_PERIOD_MS = const(500) # Of the reading in serve().
+
+n_connected = 0
+connecting = asyncio.Lock() # The controller initiates one connection at a time.
 stop = False # Loop stop flag
 
 switch = machine.Pin(0, machine.Pin.IN, machine.Pin.PULL_UP)
 def sw():
     return (not switch.value())
 
-async def main_hr(conn, char):
-    global hr_active
+async def read_hr(char):
+    data = await char.notified()
+    print(f'{time.localtime()}\t{data[1]} [bpm]')
+
+async def read_4261(char):
+    await char.write(bytes('QPID;FETC?\r\n', 'utf-8')) # 
+    data = await char.indicated(timeout_ms=1000)
+    print(f'{time.localtime()}\t{data.decode()}')
+
+class Peripheral: # A row of the table; handler(char) is called every _PERIOD_MS while connected.
+    def __init__(self, name, addr_type, addr, service, characteristic, mode, handler):
+        self.name = name
+        self.device = aioble.Device(addr_type, addr) # Compared with those of the scan by the type and the bytes.
+        self.service = service
+        self.characteristic = characteristic
+        self.mode = mode # 'notify', 'indicate' or None (to read/write only).
+        self.handler = handler
+        self.task = None
+        self.backoff_ms = _BACKOFF_MIN_MS
+
+    async def connect(self): # (connection, characteristic), or None.
+        device = self.device
+        connection = None
+        try:
+            print('Connecting to', device)
+            async with connecting:
+                ble_scan.shared.hold() # The connection cancels the scan; not started again until connected.
+                try:
+                    connection = await device.connect(timeout_ms=_CONNECT_TIMEOUT_MS)
+                finally:
+                    ble_scan.shared.release()
+            print('Connected.', connection)
+
+            service = await connection.service(self.service)
+            characteristic = await service.characteristic(self.characteristic)
+            if self.mode is not None:
+                await characteristic.subscribe(notify=self.mode == 'notify', indicate=self.mode == 'indicate')
+            return connection, characteristic
+        except asyncio.TimeoutError:
+            print("Timeout during connection")
+        except Exception as ex:
+            print('Error!', ex)
+        if connection is not None: await connection.disconnect()
+        return None
+
+    async def serve(self, conn, char): # Until disconnected.
+        try:
+            while True:
+                await asyncio.sleep(0)
+                await self.handler(char)
+                await asyncio.sleep_ms(_PERIOD_MS)
+        except asyncio.CancelledError:
+            print(f'{self.name} closed')
+            await conn.disconnect()
+            raise
+        except aioble.DeviceDisconnectedError:
+            print('DeviceDisconnectedError', self.name)
+        except Exception as ex:
+            print('Error!', self.name, ex)
+            await conn.disconnect()
+
+# Add a row here for another peripheral.
+peripherals = [
+    Peripheral('hr', aioble.ADDR_RANDOM, address_hr,
+               _HEART_RATE_SERVICE_UUID, _HEART_RATE_CHARACTERISTIC_UUID, 'notify', read_hr),
+    Peripheral('dt4261', aioble.ADDR_PUBLIC, address_dt4261,
+               _Z3210_UNKNOWN2_UUID, _Z3210_UNKNOWN2_CHAR1_UUID, 'indicate', read_4261),
+]
+
+async def keep_connected(p): # A task for each of the peripherals.
+    global n_connected
 
     try:
-        while True:
-            await asyncio.sleep(0)
-            data = await char.notified()
-            print(f'{time.localtime()}\t{data[1]} [bpm]')
-            await asyncio.sleep_ms(500)
+        while not stop:
+            # Connect only to a device advertising in the shared scan; one switched off never holds the initiator.
+            found = await ble_scan.shared.find(peer=p.device, timeout_ms=_FIND_MS)
+            if (found is not None or p.backoff_ms == _BACKOFF_MAX_MS) and n_connected < _MAX_CONNECTIONS:
+                n_connected += 1 # Including the one in connecting.
+                try:
+                    if (connected := await p.connect()) is not None:
+                        p.backoff_ms = _BACKOFF_MIN_MS
+                        await p.serve(*connected)
+                        continue
+                finally:
+                    n_connected -= 1
+            await asyncio.sleep_ms(p.backoff_ms) # Not scanning for this device meanwhile.
+            p.backoff_ms = min(p.backoff_ms * 2, _BACKOFF_MAX_MS)
     except asyncio.CancelledError:
-        print('main_hr closed')
-        await conn.disconnect()
         return
-    except aioble.DeviceDisconnectedError:
-        print('DeviceDisconnectedError')
-        hr_active = False
-    except Exception as ex:
-        print('Error!', ex)
-        hr_active = False
-
-    await conn.disconnected()
-    return
-
-async def main_4261(conn, char):
-    global dt4261_active
-
-    try:
-        while True:
-            await asyncio.sleep(0)
-            await char.write(bytes('QPID;FETC?\r\n', 'utf-8')) # 
-            data = await char.indicated(timeout_ms=1000)
-            print(f'{time.localtime()}\t{data.decode()}')
-            await asyncio.sleep_ms(500)
-    except asyncio.CancelledError:
-        print('main_4261 closed')
-        await conn.disconnect()
-        return
-    except aioble.DeviceDisconnectedError:
-        print('DeviceDisconnectedError')
-        dt4261_active = False
-    except Exception as ex:
-        print('Error!', ex)
-        dt4261_active = False
-
-    await conn.disconnected()
-    return
-
-async def conn_multiple():
-    global hr_task, dt4261_task, hr_active, dt4261_active
-
-    while not stop:
-
-        if not hr_active:
-            await asyncio.sleep(0)
-
-            device = aioble.Device(aioble.ADDR_RANDOM, address_hr)
-            connection = None
-            try:
-                print('Connecting to', device)
-                connection = await device.connect(timeout_ms=5000)
-                if connection.is_connected():
-                    print('Connected.', connection)
-
-                    service = await connection.service(_HEART_RATE_SERVICE_UUID)
-                    characteristic = await service.characteristic(_HEART_RATE_CHARACTERISTIC_UUID)
-                    await characteristic.subscribe(notify=True)
-
-                    hr_task = asyncio.create_task(main_hr(connection, characteristic))
-                    hr_active = True
-            except asyncio.TimeoutError:
-                print("Timeout during connection")
-                if connection is not None: await connection.disconnect()
-            except Exception as ex: # Not sure if this part is necessary.
-                print('Error!', ex)
-                if connection is not None: await connection.disconnect()
-
-        if not dt4261_active:
-            await asyncio.sleep(0)
-
-            device = aioble.Device(aioble.ADDR_PUBLIC, address_dt4261)
-            connection = None
-            try:
-                print('Connecting to', device)
-                connection = await device.connect(timeout_ms=5000)
-                if connection.is_connected():
-                    print('Connected.', connection)
-
-                    service = await connection.service(_Z3210_UNKNOWN2_UUID)
-                    characteristic = await service.characteristic(_Z3210_UNKNOWN2_CHAR1_UUID)
-                    await characteristic.subscribe(indicate=True)
-
-                    dt4261_task = asyncio.create_task(main_4261(connection, characteristic))
-                    dt4261_active = True
-            except asyncio.TimeoutError:
-                print("Timeout during connection")
-                if connection is not None: await connection.disconnect()
-            except Exception as ex: # Not sure if this part is necessary.
-                print('Error!', ex)
-                if connection is not None: await connection.disconnect()
-
-        await asyncio.sleep(5)
 
 async def cancel_task(task):
     await asyncio.sleep(1)
@@ -144,17 +146,18 @@ async def terminator():
                 stop = True
         await asyncio.sleep(1)
 
-    await cancel_task(hr_task)
-    await cancel_task(dt4261_task)
+    for p in peripherals:
+        await cancel_task(p.task)
 
     await asyncio.sleep(3) # Pause 3 secs to prove it.
     print("End.")
 
 async def start():
 
-    main_tasks = asyncio.create_task(conn_multiple())
+    for p in peripherals:
+        p.task = asyncio.create_task(keep_connected(p))
     terminator_task = asyncio.create_task(terminator())
-    await asyncio.gather(main_tasks, terminator_task)
+    await asyncio.gather(*(p.task for p in peripherals), terminator_task)
 
     await asyncio.sleep(1)
 
@@ -162,4 +165,5 @@ try:
     asyncio.run(start())
 finally:
     asyncio.new_event_loop()  # Clear retained state
+    ble_scan.shared.reset()
 
@@ -7,6 +7,7 @@ from micropython import const
 import asyncio
 import aioble
 import bluetooth
+import ble_scan
 
 import time
 
@@ -36,17 +37,12 @@ _Z3210_UNKNOWN2_CHAR1_UUID = bluetooth.UUID('78b028ce-affd-4967-ab9e-dc336c8c94e
 _Z3210_UNKNOWN2_CHAR2_UUID = bluetooth.UUID('872f065a-5297-4483-9183-27cd72f7cffc')
 
 async def find_voltmeter():
-    # Scan for 5 seconds, in active mode, with very low interval/window (to
-    # maximise detection rate).
-    async with aioble.scan(5000, interval_us=30000, window_us=30000, active=True) as scanner:
-        async for result in scanner:
-            # See if it matches the name and the service.
-            #print(result.name())
-            #e.g. "Z3210V2.10:DT4261#xxxxxxxxx", where DT4261 and xxxxxxxxx are model number and the serial number.
-            if str(result.name())[:10] == "Z3210V2.10" and _Z3210_HID_UUID in result.services():
-                print(result.device)
-                return result.device
-    return None
+    # Wait for 5 seconds for the name and the service in the shared scan (ble_scan.py).
+    #e.g. "Z3210V2.10:DT4261#xxxxxxxxx", where DT4261 and xxxxxxxxx are model number and the serial number.
+    device = await ble_scan.shared.find(name="Z3210V2.10", service=_Z3210_HID_UUID, timeout_ms=5000)
+    if device:
+        print(device)
+    return device
 
 async def main():
     if address:
@@ -98,4 +94,7 @@ async def main():
                 return
 
 def start():
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        ble_scan.shared.reset()
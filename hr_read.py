@@ -7,6 +7,7 @@ from micropython import const
 import asyncio
 import aioble
 import bluetooth
+import ble_scan
 
 import random
 import struct
@@ -32,14 +33,8 @@ def _heart_rate_data_handler(data):
     print(time.localtime(), '\t', hr, sep = '')
 
 async def find_hr_sensor():
-    # Scan for 5 seconds, in active mode, with very low interval/window (to
-    # maximise detection rate).
-    async with aioble.scan(5000, interval_us=30000, window_us=30000, active=True) as scanner:
-        async for result in scanner:
-            # See if it matches the name and the service of the heart rate seonsor.
-            if result.name() == _HR_SENSOR_NAME and _HEART_RATE_SERVICE_UUID in result.services():
-                return result.device
-    return None
+    # Wait for 5 seconds for the name and the service of the heart rate sensor in the shared scan (ble_scan.py).
+    return await ble_scan.shared.find(name=_HR_SENSOR_NAME, service=_HEART_RATE_SERVICE_UUID, timeout_ms=5000, exact=True)
 
 _init = True
 async def main():
@@ -83,4 +78,7 @@ async def main():
 
 def start():
     while True:
-        asyncio.run(main())
+        try:
+            asyncio.run(main())
+        finally:
+            ble_scan.shared.reset()
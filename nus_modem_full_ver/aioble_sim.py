@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/micropython_aioble_examples
+#
+# A simulated BLE link for running nus_modem_server.py and nus_modem_client.py against each other on CPython.
+# install() puts stand-ins of aioble, bluetooth, micropython, machine and deflate in sys.modules; run() runs a
+# coroutine on an event loop of virtual time, so the throughput is that of the link model, not of the host CPU.
+#
+# The link models
+#   MTU (the smaller of those asked by both sides and LinkParams.mtu),
+#   connection interval (min_conn_interval_us asked by the central, or LinkParams.conn_interval_ms as updated soon after),
+#   packets per connection event (both directions share them),
+#   depth of the queues of notifications and of writes in the controllers (notify() and write() raise ENOMEM when full),
+#   loss of notifications delivered to the central (as an overflow in the host stack does).
+
+import sys
+import os
+import types
+import asyncio
+import builtins
+import time
+import random
+import errno
+import zlib
+from collections import deque
+
+_IRQ_GATTC_NOTIFY = 18
+_IRQ_CONNECTION_UPDATE = 27
+
+_ADDR_PERIPHERAL = 'e3:c3:5c:4a:77:a4'
+_ADDR_CENTRAL = 'c0:ff:ee:00:00:01'
+
+
+class LinkParams:
+    def __init__(self, mtu=512, conn_interval_ms=None, packets_per_event=6, tx_buffers=64, loss=0.0, seed=1):
+        self.mtu = mtu # The largest MTU of the controllers.
+        self.conn_interval_ms = conn_interval_ms # None to accept the interval asked by the central.
+        self.packets_per_event = packets_per_event # Packets in a connection event, in both directions.
+        self.tx_buffers = tx_buffers # Depth of the notification queue of the peripheral, and of the write queue of the central.
+        self.loss = loss # Rate of notifications lost.
+        self.seed = seed
+
+
+class LinkStats: # Counted over the connections since install().
+    def __init__(self):
+        self.events = 0
+        self.notified = 0
+        self.dropped = 0
+        self.written = 0
+        self.tx_full = 0 # notify() or write() on a full queue.
+        self.write_dropped = 0 # Writes dropped by the full queue of a characteristic (capture).
+
+
+_params = LinkParams()
+stats = LinkStats()
+
+
+def _now():
+    return asyncio.get_event_loop().time()
+
+
+def install(params=None, sd_dir=None):
+    """Install the stand-ins; paths starting with /sd are mapped to sd_dir if given."""
+    global _params, stats
+    _params = params or LinkParams()
+    stats = LinkStats()
+
+    mp = types.ModuleType('micropython')
+    mp.const = lambda x: x
+    mp.viper = mp.native = lambda f: f
+    sys.modules['micropython'] = mp
+    builtins.micropython = mp # @micropython.viper is resolved by the compiler of MicroPython without import.
+    builtins.ptr8 = builtins.ptr16 = builtins.ptr32 = lambda x: x
+
+    machine = types.ModuleType('machine')
+    machine.freq = lambda *args: 240_000_000
+    sys.modules['machine'] = machine
+
+    bt = types.ModuleType('bluetooth')
+    bt.UUID = UUID
+    sys.modules['bluetooth'] = bt
+
+    if 'deflate' not in sys.modules:
+        sys.modules['deflate'] = _build_deflate()
+
+    asyncio.ThreadSafeFlag = ThreadSafeFlag
+    asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    asyncio.wait_for_ms = lambda aw, ms: asyncio.wait_for(aw, ms / 1000)
+    time.ticks_ms = lambda: int(_now() * 1_000)
+    time.ticks_us = lambda: int(_now() * 1_000_000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+
+    sys.modules['aioble'] = _build_aioble()
+
+    if sd_dir:
+        _map_sd(sd_dir)
+
+
+def run(coro_factory):
+    """Run coro_factory() on a new event loop of virtual time; sleeps take no time of the host."""
+    loop = asyncio.new_event_loop()
+    _install_virtual_clock(loop)
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro_factory())
+    finally:
+        tasks = asyncio.all_tasks(loop) # The links and the server, left at the end of the transfer.
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+
+def _install_virtual_clock(loop):
+    t = [0.0]
+    select = loop._selector.select
+
+    def virtual_select(timeout=None): # Advance the clock to the next timer instead of waiting for it.
+        if timeout:
+            t[0] += timeout
+        return select(0)
+    loop.time = lambda: t[0]
+    loop._selector.select = virtual_select
+
+
+def _map_sd(sd_dir):
+    def path(p):
+        return sd_dir + p[3:] if isinstance(p, str) and (p == '/sd' or p.startswith('/sd/')) else p
+
+    def wrap(func):
+        return lambda p, *args, **kwargs: func(path(p), *args, **kwargs)
+    builtins.open = wrap(builtins.open)
+    os.listdir = wrap(os.listdir)
+    os.stat = wrap(os.stat)
+    os.remove = wrap(os.remove)
+    rename = os.rename
+    os.rename = lambda src, dst: rename(path(src), path(dst))
+
+
+class UUID:
+    def __init__(self, value):
+        self.value = value.lower() if isinstance(value, str) else value
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and other.value == self.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return f'UUID({self.value!r})'
+
+
+class ThreadSafeFlag:
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+
+def _build_deflate(): # deflate of MicroPython on zlib; the whole stream is (de)compressed at once.
+    deflate = types.ModuleType('deflate')
+    deflate.AUTO, deflate.RAW, deflate.ZLIB, deflate.GZIP = 0, 1, 2, 3
+
+    class DeflateIO:
+        def __init__(self, stream, format=deflate.AUTO, wbits=0, close=False):
+            self.stream = stream
+            self.format = format
+            self.wbits = wbits
+            self.close_stream = close
+            self.wbuf = None
+            self.rbuf = None
+            self.ridx = 0
+
+        def zlib_wbits(self, compress):
+            wbits = max(9, self.wbits or (8 if compress else 15))
+            if self.format == deflate.RAW: return -wbits
+            if self.format == deflate.GZIP: return 16 + wbits
+            if self.format == deflate.AUTO and not compress: return 32 + 15
+            return wbits
+
+        def write(self, data):
+            if self.wbuf is None: self.wbuf = bytearray()
+            self.wbuf += data
+            return len(data)
+
+        def readinto(self, buf):
+            if self.rbuf is None:
+                self.rbuf = zlib.decompressobj(self.zlib_wbits(False)).decompress(self.stream.read())
+            n = min(len(buf), len(self.rbuf) - self.ridx)
+            buf[:n] = self.rbuf[self.ridx:self.ridx + n]
+            self.ridx += n
+            return n
+
+        def read(self, n=-1):
+            buf = bytearray(n if n >= 0 else len(self.rbuf or b'') or 1 << 20)
+            return bytes(buf[:self.readinto(buf)])
+
+        def close(self):
+            if self.wbuf is not None:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, self.zlib_wbits(True))
+                self.stream.write(compressor.compress(bytes(self.wbuf)) + compressor.flush())
+                self.wbuf = None
+            if self.close_stream: self.stream.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+    deflate.DeflateIO = DeflateIO
+    return deflate
+
+
+def _build_aioble():
+    aioble = types.ModuleType('aioble')
+    core = types.ModuleType('aioble.core')
+    client = types.ModuleType('aioble.client')
+    aioble.core = core
+    aioble.client = client
+    sys.modules['aioble.core'] = core
+    sys.modules['aioble.client'] = client
+
+    _irq_handlers = []
+    core._irq_handlers = _irq_handlers # Clients insert their own handlers in front of that of aioble.
+
+    def register_irq_handler(irq, shutdown=None):
+        if irq:
+            _irq_handlers.append(irq)
+    core.register_irq_handler = register_irq_handler
+
+    def ble_irq(event, data):
+        for handler in _irq_handlers:
+            result = handler(event, data)
+            if result is not None:
+                return result
+    core.ble_irq = ble_irq
+
+    aioble.ADDR_PUBLIC = 0
+    aioble.ADDR_RANDOM = 1
+
+    class DeviceDisconnectedError(Exception):
+        pass
+    aioble.DeviceDisconnectedError = DeviceDisconnectedError
+
+    class GattError(Exception):
+        def __init__(self, status):
+            self._status = status
+    aioble.GattError = GattError
+
+    state = types.SimpleNamespace(advertisers=[], services=[], config_mtu=23, handle=16, conn_handle=0)
+
+    def config(mtu=None, **kwargs):
+        if mtu:
+            state.config_mtu = mtu
+    aioble.config = config
+
+    class Service: # Handles: the service, and the declaration, value and CCCD (if notified) of each characteristic.
+        def __init__(self, uuid):
+            self.uuid = uuid
+            self.characteristics = []
+            state.handle += 1
+            self._start_handle = state.handle
+
+        @property
+        def _end_handle(self):
+            return max([self._start_handle] + [c._cccd_handle or c._value_handle for c in self.characteristics])
+    aioble.Service = Service
+
+    class Characteristic:
+        def __init__(self, service, uuid, read=False, write=False, write_no_response=False,
+                     notify=False, indicate=False, initial=None, capture=False):
+            service.characteristics.append(self)
+            self.uuid = uuid
+            state.handle += 2
+            self._value_handle = state.handle
+            self._cccd_handle = None
+            if notify or indicate:
+                state.handle += 1
+                self._cccd_handle = state.handle
+            self.properties = read << 1 | write_no_response << 2 | write << 3 | notify << 4 | indicate << 5
+            self._write_event = ThreadSafeFlag()
+            self._write_queue = deque((), 10 if capture else 1)
+            self._capture = capture
+
+        def notify(self, connection, data=None):
+            connection._link.notify(self._value_handle, data)
+
+        def _on_write(self, connection, data): # As aioble; the flag is set only when the queue was empty.
+            if len(self._write_queue) == self._write_queue.maxlen:
+                stats.write_dropped += 1 # The oldest one is dropped.
+            wake = len(self._write_queue) == 0
+            self._write_queue.append((connection, data) if self._capture else connection)
+            if wake:
+                self._write_event.set()
+
+        async def written(self, timeout_ms=None): # As aioble; waits on the flag with one item left.
+            if len(self._write_queue) <= 1:
+                await asyncio.wait_for(self._write_event.wait(), None if timeout_ms is None else timeout_ms / 1000)
+            return self._write_queue.popleft()
+    aioble.Characteristic = Characteristic
+
+    class BufferedCharacteristic(Characteristic):
+        def __init__(self, service, uuid, max_len=20, append=False, **kwargs):
+            super().__init__(service, uuid, **kwargs)
+    aioble.BufferedCharacteristic = BufferedCharacteristic
+
+    def register_services(*services):
+        state.services = list(services)
+    aioble.register_services = register_services
+
+    class Device:
+        def __init__(self, addr_type, addr):
+            self.addr_type = addr_type
+            self.addr = addr.lower() # As the bytes of aioble, whatever the case of the string.
+
+        def __eq__(self, rhs): # As aioble.
+            return isinstance(rhs, Device) and self.addr_type == rhs.addr_type and self.addr == rhs.addr
+
+        def __hash__(self):
+            return hash((self.addr_type, self.addr))
+
+        def __repr__(self):
+            return f"Device({'ADDR_PUBLIC' if self.addr_type == 0 else 'ADDR_RANDOM'}, {self.addr})"
+
+        def addr_hex(self):
+            return self.addr
+
+        async def connect(self, timeout_ms=10_000, scan_duration_ms=None,
+                          min_conn_interval_us=None, max_conn_interval_us=None):
+            deadline = _now() + timeout_ms / 1000
+            while _now() < deadline:
+                for adv in state.advertisers:
+                    if adv.device.addr == self.addr:
+                        state.advertisers.remove(adv)
+                        link = Link((min_conn_interval_us or 30_000) / 1000)
+                        link.central = DeviceConnection(adv.device, link)
+                        link.peripheral = DeviceConnection(Device(aioble.ADDR_PUBLIC, _ADDR_CENTRAL), link)
+                        link.start()
+                        await link.events(2)
+                        adv.future.set_result(link.peripheral)
+                        if _params.conn_interval_ms and _params.conn_interval_ms * 1000 != min_conn_interval_us:
+                            asyncio.create_task(link.update(_params.conn_interval_ms))
+                        return link.central
+                await asyncio.sleep(0.1)
+            raise asyncio.TimeoutError
+    aioble.Device = Device
+
+    class Link: # A connection; notifications and writes are delivered at connection events.
+        def __init__(self, interval_ms):
+            self.interval = interval_ms / 1000
+            self.mtu = 23
+            self.to_central = deque()
+            self.to_peripheral = deque()
+            self.connected = True
+            self.event_count = 0
+            self.event_flag = asyncio.Event()
+            self.rng = random.Random(_params.seed)
+
+        def start(self):
+            self.task = asyncio.create_task(self.run())
+
+        async def update(self, interval_ms): # Connection parameter update; both sides get _IRQ_CONNECTION_UPDATE.
+            await self.events(6)
+            self.interval = interval_ms / 1000
+            for connection in (self.central, self.peripheral):
+                ble_irq(_IRQ_CONNECTION_UPDATE, (connection._conn_handle, round(interval_ms / 1.25), 0, 400, 0))
+
+        async def events(self, n): # Wait for n connection events, e.g. for a request and its response.
+            target = self.event_count + n
+            while self.event_count < target and self.connected:
+                self.event_flag.clear()
+                await self.event_flag.wait()
+
+        def notify(self, value_handle, data):
+            if not self.connected:
+                raise OSError(errno.ENOTCONN)
+            if len(self.to_central) >= _params.tx_buffers:
+                stats.tx_full += 1
+                raise OSError(errno.ENOMEM)
+            self.to_central.append((value_handle, bytes(data[:self.mtu - 3])))
+
+        def write(self, value_handle, data):
+            if not self.connected:
+                raise OSError(errno.ENOTCONN)
+            if len(self.to_peripheral) >= _params.tx_buffers:
+                stats.tx_full += 1
+                raise OSError(errno.ENOMEM)
+            self.to_peripheral.append((value_handle, bytes(data[:self.mtu - 3])))
+
+        def deliver_write(self, value_handle, data):
+            stats.written += 1
+            for service in state.services:
+                for characteristic in service.characteristics:
+                    if characteristic._value_handle == value_handle:
+                        characteristic._on_write(self.peripheral, data)
+
+        def deliver_notify(self, value_handle, data):
+            if _params.loss and self.rng.random() < _params.loss:
+                stats.dropped += 1
+                return
+            stats.notified += 1
+            ble_irq(_IRQ_GATTC_NOTIFY, (self.central._conn_handle, value_handle, memoryview(data)))
+
+        async def run(self):
+            while self.connected:
+                await asyncio.sleep(self.interval)
+                n = _params.packets_per_event
+                while n and (self.to_central or self.to_peripheral): # Alternate the directions in an event.
+                    if self.to_peripheral:
+                        self.deliver_write(*self.to_peripheral.popleft())
+                        n -= 1
+                    if n and self.to_central:
+                        self.deliver_notify(*self.to_central.popleft())
+                        n -= 1
+                self.event_count += 1
+                stats.events += 1
+                self.event_flag.set()
+
+        def close(self):
+            self.connected = False
+            self.event_flag.set()
+            for connection in (self.central, self.peripheral):
+                connection._disconnected.set()
+
+    class DeviceConnection:
+        _connected = {}
+
+        def __init__(self, device, link):
+            self.device = device
+            self._link = link
+            state.conn_handle += 1
+            self._conn_handle = state.conn_handle
+            self._characteristics = {}
+            self._disconnected = asyncio.Event()
+            DeviceConnection._connected[self._conn_handle] = self
+
+        @property
+        def mtu(self):
+            return self._link.mtu
+
+        def is_connected(self):
+            return self._link.connected
+
+        async def disconnect(self, timeout_ms=2_000):
+            if self._link.connected:
+                await self._link.events(1)
+                self._link.close()
+
+        async def disconnected(self, timeout_ms=None):
+            await self._disconnected.wait()
+
+        async def exchange_mtu(self, mtu=None, timeout_ms=1_000):
+            await self._link.events(2)
+            self._link.mtu = min(mtu or 23, state.config_mtu, _params.mtu)
+
+        async def service(self, uuid, timeout_ms=2_000):
+            await self._link.events(2)
+            for service in state.services:
+                if service.uuid == uuid:
+                    return ClientService(self, service._start_handle, service._end_handle, uuid)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            await self.disconnect()
+    aioble.DeviceConnection = DeviceConnection
+
+    def _server_characteristic(value_handle): # Of the peripheral; the central finds it by handles, as the stack does.
+        for service in state.services:
+            for characteristic in service.characteristics:
+                if characteristic._value_handle == value_handle:
+                    return characteristic
+
+    class ClientService: # As aioble; constructed by discovery, or from the handles cached by the client.
+        def __init__(self, connection, start_handle, end_handle, uuid):
+            self.connection = connection
+            self._start_handle = start_handle
+            self._end_handle = end_handle
+            self.uuid = uuid
+
+        async def characteristic(self, uuid, timeout_ms=2_000):
+            await self.connection._link.events(2)
+            for service in state.services:
+                for c in service.characteristics:
+                    if c.uuid == uuid and self._start_handle <= c._value_handle <= self._end_handle:
+                        return ClientCharacteristic(self, c._cccd_handle or c._value_handle, c._value_handle, c.properties, uuid)
+    client.ClientService = ClientService
+
+    class ClientCharacteristic:
+        def __init__(self, service, end_handle, value_handle, properties, uuid): # As aioble.
+            self.service = service
+            self._connection = service.connection
+            self._end_handle = end_handle if end_handle > value_handle else value_handle + 2
+            self._value_handle = value_handle
+            self.properties = properties
+            self.uuid = uuid
+            self._notify_event = ThreadSafeFlag()
+            self._notify_queue = deque((), 1)
+
+        def _register_with_connection(self):
+            self._connection._characteristics[self._value_handle] = self
+
+        async def descriptor(self, uuid, timeout_ms=2_000):
+            await self._connection._link.events(2)
+            c = _server_characteristic(self._value_handle)
+            if c and c._cccd_handle and uuid == UUID(0x2902):
+                return ClientDescriptor(self, c._cccd_handle, uuid)
+
+        async def subscribe(self, notify=True, indicate=False):
+            self._register_with_connection()
+            await (await self.descriptor(UUID(0x2902))).write(b'\x01\x00', response=True)
+
+        async def write(self, data, response=None, timeout_ms=1_000):
+            self._connection._link.write(self._value_handle, data)
+            if response: # Wait for the write response.
+                await self._connection._link.events(2)
+
+        async def notified(self, timeout_ms=None):
+            if len(self._notify_queue) <= 1:
+                await asyncio.wait_for(self._notify_event.wait(), None if timeout_ms is None else timeout_ms / 1000)
+            return self._notify_queue.popleft()
+
+        def _on_notify_indicate(self, queue, event, data):
+            wake = len(queue) == 0
+            queue.append(data)
+            if wake:
+                event.set()
+
+        @staticmethod
+        def _find(conn_handle, value_handle):
+            if (connection := DeviceConnection._connected.get(conn_handle)):
+                return connection._characteristics.get(value_handle)
+
+        @staticmethod
+        def _on_notify(conn_handle, value_handle, notify_data):
+            if (characteristic := ClientCharacteristic._find(conn_handle, value_handle)):
+                characteristic._on_notify_indicate(
+                    characteristic._notify_queue, characteristic._notify_event, notify_data)
+    client.ClientCharacteristic = ClientCharacteristic
+    aioble.ClientCharacteristic = ClientCharacteristic
+
+    class ClientDescriptor:
+        def __init__(self, characteristic, dsc_handle, uuid):
+            self.characteristic = characteristic
+            self._value_handle = dsc_handle
+            self.uuid = uuid
+
+        async def write(self, data, response=None, timeout_ms=1_000):
+            connection = self.characteristic._connection
+            await connection._link.events(2 if response else 1)
+            if response and not any(c._cccd_handle == self._value_handle
+                                    for service in state.services for c in service.characteristics):
+                raise GattError(0x01) # Invalid handle.
+    client.ClientDescriptor = ClientDescriptor
+
+    def _client_irq(event, data):
+        if event == _IRQ_GATTC_NOTIFY:
+            conn_handle, value_handle, notify_data = data
+            ClientCharacteristic._on_notify(conn_handle, value_handle, bytes(notify_data))
+    client._client_irq = _client_irq
+    register_irq_handler(_client_irq)
+
+    class Advertiser:
+        def __init__(self, name, services):
+            self.name = name
+            self.services = services
+            self.device = Device(aioble.ADDR_RANDOM, _ADDR_PERIPHERAL)
+            self.future = asyncio.get_event_loop().create_future()
+
+    async def advertise(interval_us, name=None, services=None, appearance=0, **kwargs):
+        adv = Advertiser(name, services or [])
+        state.advertisers.append(adv)
+        return await adv.future # The connection, once a central connects.
+    aioble.advertise = advertise
+
+    class ScanResult:
+        def __init__(self, adv):
+            self.device = adv.device
+            self._adv = adv
+            self.rssi = -50
+            self.adv_data = bytes(adv.name or '', 'utf-8') # Not decoded by name() nor services() here.
+            self.resp_data = None
+
+        def name(self):
+            return self._adv.name
+
+        def services(self):
+            yield from self._adv.services
+
+    class scan:
+        def __init__(self, duration_ms, interval_us=None, window_us=None, active=False):
+            self.duration = duration_ms / 1000
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        def __aiter__(self):
+            return self.results()
+
+        async def results(self): # Every advertiser, every 100 ms.
+            deadline = _now() + self.duration
+            while _now() < deadline:
+                for adv in list(state.advertisers):
+                    yield ScanResult(adv)
+                await asyncio.sleep(0.1)
+    aioble.scan = scan
+
+    return aioble
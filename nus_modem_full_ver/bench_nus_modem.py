@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/micropython_aioble_examples
+#
+# Throughput of the YMODEM/NUS modem pair over a matrix of parameters of the simulated link (sim_nus_modem.py).
+# Each case runs in a process of its own, as the stand-ins of aioble_sim.py are installed per process.
+# e.g. python bench_nus_modem.py --mtu 23,209,512 --interval 7.5,15,50 --loss 0,0.01 --out bench.json
+#      python bench_nus_modem.py --direction down,up --mode g --blocks large --loss 0
+
+import sys
+import os
+import argparse
+import itertools
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+_SIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim_nus_modem.py')
+
+# Axes of the matrix; the name of the option of sim_nus_modem.py, and the type of the values.
+_AXES = (
+    ('direction', str, 'down'),
+    ('mode', str, 'g,c'),
+    ('blocks', str, 'std,large'),
+    ('mtu', int, '23,209,512'),
+    ('interval', float, '7.5,15,50'),
+    ('packets', int, '6'),
+    ('queue', int, '64'),
+    ('loss', float, '0,0.01'),
+    ('size', int, '100000'),
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the YMODEM/NUS modem pair on a simulated BLE link.')
+    for name, _, default in _AXES:
+        parser.add_argument(f'--{name}', default=default, help=f'comma separated (default: {default})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='cases run at once')
+    parser.add_argument('--out', help='write the results to this file (JSON)')
+    parser.add_argument('--compare', help='results of a previous run (JSON) to compare the throughput with')
+    return parser.parse_args(argv)
+
+
+def cases(args):
+    values = [[kind(v) for v in getattr(args, name).split(',')] for name, kind, _ in _AXES]
+    for combination in itertools.product(*values):
+        case = dict(zip((name for name, _, _ in _AXES), combination))
+        if case['blocks'] == 'std' or case['mtu'] > 23: # Large blocks need MTU > 23.
+            yield case
+
+
+def run_case(case, seed):
+    argv = [sys.executable, _SIM, '--quiet', '--json', '--seed', str(seed)]
+    for name, value in case.items():
+        argv += [f'--{name}', str(value)]
+    proc = subprocess.run(argv, capture_output=True, text=True, cwd=os.path.dirname(_SIM))
+    try:
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        result = {'ok': False, 'error': (proc.stderr.strip().splitlines() or ['no output'])[-1]}
+    return dict(case, **result)
+
+
+def key(result):
+    return tuple(result[name] for name, _, _ in _AXES)
+
+
+def print_table(results, baseline):
+    columns = [name for name, _, _ in _AXES] + ['block', 'kbps', 'data kbps', 'first block ms', 'resent', 'lost', 'queue full', 'cpu/block ms', '']
+    print('| ' + ' | '.join(columns) + ' |')
+    print('|' + '---|' * len(columns))
+    for r in results:
+        change = ''
+        if (b := baseline.get(key(r))) and b.get('data_kbps'):
+            change = f"{(r.get('data_kbps', 0) / b['data_kbps'] - 1) * 100:+.1f}%"
+        cpu_per_block = r.get('cpu_per_block')
+        row = [r[name] for name, _, _ in _AXES] + [
+            r.get('block_size', ''), f"{r.get('kbps', 0):.1f}", f"{r.get('data_kbps', 0):.1f}",
+            r.get('first_block_ms') if r.get('first_block_ms') is not None else '', r.get('resent', ''), r.get('dropped', ''), r.get('tx_full', ''),
+            f'{cpu_per_block * 1000:.2f}' if cpu_per_block else '',
+            change if r.get('ok') else f"FAILED {r.get('error') or ''}"]
+        print('| ' + ' | '.join(str(v) for v in row) + ' |')
+
+
+def main():
+    args = parse_args()
+    matrix = list(cases(args))
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda case: run_case(case, args.seed), matrix))
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {key(r): r for r in json.load(f)}
+    print_table(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    return all(r.get('ok') for r in results)
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
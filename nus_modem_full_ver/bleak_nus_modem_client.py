@@ -13,6 +13,9 @@ import os
 import time
 import datetime
 import platform
+import zlib
+
+from crc16_arc import crc16_arc
 
 TARGET_NAME = "mpy-nus"
 #SERVICE_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
@@ -21,6 +24,7 @@ RX_CHARACTERISTIC_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
 
 VALUE_SOH = bytearray([0x01])                             # SOH == 128-byte data
 VALUE_STX = bytearray([0x02])                             # STX == 1024-byte data
+VALUE_BLK = bytearray([0x03])                             # Non-standard; data of the size negotiated in block zero
 VALUE_C = bytearray([0x43])                               # 'C'
 #VALUE_G = bytearray([0x47])                               # 'G'
 VALUE_ACK = bytearray([0x06])                             # ACK
@@ -28,48 +32,80 @@ VALUE_NAK = bytearray([0x15])                             # NAK
 VALUE_EOT = bytearray([0x04])                             # EOT
 VALUE_CAN = bytearray([0x18])                             # CAN
 
+_ZREC_DEFLATE = 0x8000 # Deflate record; otherwise the data are stored as they are.
+_ZREC_LAST = 0x4000 # The last record of the file.
+
+_WRITE_BUFFER = 1 << 16 # Bytes buffered in writing the file.
+
 AWAIT_NEW_DATA = bytearray(b'AwaitNewData')
 
 class NUSModemClient:
-    def __init__(self):
-        self.lock = asyncio.Lock()
+    def __init__(self, directory=''):
         # **Packet**
         self.notification_data = bytearray()
         self.mtu_size = 23
         # **Block**
-        self.block_buf = bytearray(3 + 1024 + 2)                                 # Header(SOH/STX, num, ~num); data(128 or 1024 bytes); CRC16
+        self.block_buf = None
+        self.mv_block_buf = None
+        self.block_size_data_crc = None
+        self.set_block_buf(0)
         self.block_num = 0 # Block number(0-255).
         self.idx_block_buf = 0 # Index in block_buf.
-        self.mv_block_buf = memoryview(self.block_buf)
         self.block_size = None
         self.block_data = None
         self.block_crc = None
-        self.block_size_data_crc = (
-            (3 + 128 + 2, self.mv_block_buf[3:131], self.mv_block_buf[131:133], ), # SOH
-            (3 + 1024 + 2, self.mv_block_buf[3:-2], self.mv_block_buf[-2:], ),     # STX
-        )
         self.block_error = False
+        self.block_ready = None # Future completed by the notification handler when a block (or EOT) is received.
         # **File**                                                               A file is made of blocks; a block is made of packets.
-        self.data = bytearray()
+        self.file = None # Written as the blocks are verified; None while reading block zero.
         self.data_size = 0
+        self.data_written = 0
         self.filename = ''
+        self.directory = directory # Where the files are stored; one for each device in fetching from many.
         self.is_download = False
+        self.use_deflate = False
+        self.zrec = bytearray() # Deflate records received partly.
+
+    def set_block_buf(self, large_size):
+        self.block_buf = bytearray(3 + max(1024, large_size) + 2)                # Header(SOH/STX/BLK, num, ~num); data(128, 1024 or large_size bytes); CRC16
+        self.mv_block_buf = memoryview(self.block_buf)
+        self.block_size_data_crc = { # By the header.
+            header[0]: (3 + n + 2, self.mv_block_buf[3:3 + n], self.mv_block_buf[3 + n:5 + n], )
+            for header, n in ((VALUE_SOH, 128), (VALUE_STX, 1024), (VALUE_BLK, large_size))}
+
+    def choose_large_size(self, size_max): # A multiple of the ATT payload minus 5, if it carries more per packet than STX.
+        payload = self.mtu_size - 3
+        n_packets = (size_max + 5) // payload
+        size = n_packets * payload - 5
+        n_packets_stx = (3 + 1024 + 2 + payload - 1) // payload
+        return size if self.mtu_size > 23 and size * n_packets_stx > 1024 * n_packets else 0
 
     def create_notification_handler(self):
-        async def notification_handler(sender, data):
+        def notification_handler(sender, data): # Called in the event loop; no lock is necessary as it never awaits.
             ##print(data) # For test.
             if data == VALUE_EOT:                                               # Receive EOT.
                 self.is_download = False
                 self.notification_data = data
+                self.complete_block()
             elif self.is_download:                                              # Packets should be combined to make a block.
-                async with self.lock: # Use asyncio.Lock() for safety.
-                    self.mv_block_buf[self.idx_block_buf:self.idx_block_buf + (len_data := len(data))] = data
-                    self.idx_block_buf += len_data
+                idx = self.idx_block_buf
+                if idx == 0:                                                    # The header tells the size of the block.
+                    self.block_size, self.block_data, self.block_crc = self.block_size_data_crc.get(
+                        data[0], self.block_size_data_crc[VALUE_SOH[0]])
+                n = min(len(data), self.block_size - idx)                       # Never beyond the block.
+                self.mv_block_buf[idx:idx + n] = data[:n]
+                self.idx_block_buf = idx + n
+                if self.idx_block_buf >= self.block_size:
+                    self.complete_block()
             else:
                 self.notification_data = data                                   # Other messages/responses.
 
         return notification_handler
 
+    def complete_block(self):
+        if self.block_ready is not None and not self.block_ready.done():
+            self.block_ready.set_result(None)
+
     async def discover_device(self, target_name):
         print("Scanning for Bluetooth devices...")
         retries = 3
@@ -109,27 +145,19 @@ class NUSModemClient:
         await self.read_block(client)
 
     async def read_block(self, client):
-        #_SOH = VALUE_SOH[0] # SOH == 128-byte data
-        _STX = VALUE_STX[0] # STX == 1024-byte data
-        async def check_block_buf():
-            while self.is_download and self.idx_block_buf == 0:
-                await asyncio.sleep(0.01)
-            if not self.is_download: return
-            self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.block_buf[0] == _STX)]
-            while self.idx_block_buf < self.block_size:
-                await asyncio.sleep(0.01)
-
         try:
-            await asyncio.wait_for(check_block_buf(), timeout=10)
+            if self.is_download and (self.idx_block_buf == 0 or self.idx_block_buf < self.block_size):
+                self.block_ready = asyncio.get_running_loop().create_future()
+                await asyncio.wait_for(self.block_ready, timeout=10)                 # Completed by the notification handler.
             if not self.is_download: return # The 1st EOT may arrive very late.
-            if int.from_bytes(self.block_crc, 'big') != self.crc16_arc(self.block_data):
+            if int.from_bytes(self.block_crc, 'big') != crc16_arc(self.block_data):
                 self.block_error = True
                 print(f'Size: {self.idx_block_buf}')
             else:
-                self.data.extend(self.block_data)                                # Blocks should be combined to make a file.
                 if self.block_buf[1] == (self.block_num + 1) % 256:
+                    if self.file: self.save_block()                              # Blocks should be combined to make a file.
                     if self.block_error: print(f'Fixed error in block{self.block_buf[1]}.')
-                else:
+                else: # A duplicate; ACK without saving.
                     print(f'Unexpected block: {self.block_num} -> {self.block_buf[1]}')
                 self.block_num = self.block_buf[1]
                 self.block_error = False
@@ -168,29 +196,49 @@ class NUSModemClient:
             return
 
         file_informations = self.block_data.tobytes().rstrip(b'\x00').decode('utf-8').split()
-        self.filename = file_informations[0]
+        self.filename = os.path.basename(file_informations[0])
         self.data_size = int(file_informations[1])
-        if os.path.exists(self.filename):
-            os.replace(f'{self.filename}', f'{self.filename}.old')
-        self.data = bytearray() # Where the file to be stored.
+        large_size = 0
+        self.use_deflate = False
+        for option in file_informations[2:]:
+            if option[0] == 'B': # Large blocks of data up to N bytes are available.
+                large_size = self.choose_large_size(int(option[1:]))
+            elif option[0] == 'Z': # Records of deflate are available.
+                self.use_deflate = True
+        filepath = os.path.join(self.directory, self.filename)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(filepath):
+            os.replace(filepath, f'{filepath}.old')
 
         print(time.asctime())
         await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0.1)       # Send ACK.
-        await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_C, 0.1)         # Send 'C'.
-
-        # Blocks of num>=1 should be combined to obtain the file.
-        while self.is_download:                                                       # Receive EOT to exit this loop.
-            await self.read_block(client)
-            if not self.is_download: break # The 1st EOT may arrive very late.
-            if self.block_error:
-                self.is_download = False # Wait 0.2 s for garbage.
-                await asyncio.sleep(0.2)
-                self.is_download = True
-                await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0.01) # Send NAK on error.
-            else:
-                await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0.01) # Send ACK.
+        self.set_block_buf(large_size)
+        self.data_written = 0
+        self.zrec.clear()
+        with open(filepath, 'wb', buffering=_WRITE_BUFFER) as self.file:     # Where the file to be stored, block by block.
+            options = f' B{large_size}' if large_size else ''
+            options += ' Z' if self.use_deflate else ''
+            await self.send_cmd(client, RX_CHARACTERISTIC_UUID,                    # Send 'C', the size of large blocks and deflate.
+                bytes(f'C{options}', 'utf-8'), 0.1)
+
+            # Blocks of num>=1 should be combined to obtain the file.
+            while self.is_download:                                                   # Receive EOT to exit this loop.
+                await self.read_block(client)
+                if not self.is_download: break # The 1st EOT may arrive very late.
+                if self.block_error:
+                    self.is_download = False # Wait 0.2 s for garbage.
+                    await asyncio.sleep(0.2)
+                    self.is_download = True
+                    await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_NAK, 0.01) # Send NAK on error.
+                else:
+                    await self.send_cmd(client, RX_CHARACTERISTIC_UUID, VALUE_ACK, 0.01) # Send ACK.
+        self.file = None
         await self.end_of_transfer(client)
-        self.save_file_raw(self.filename)
+        if self.data_written != self.data_size:
+            print(f"Error: {self.data_written}(file size) != {self.data_size}(spec)")
+        else:
+            print(f"Successfully wrote combined data to {filepath}")
         print(time.asctime())
 
     async def wait_until_data(self, client):
@@ -207,7 +255,10 @@ class NUSModemClient:
         if not device:
             print(f"{TARGET_NAME} not found")
             return
+        await self.download(device)
 
+    async def download(self, device): # Returns the size of the file written.
+        self.data_written = 0
         async with BleakClient(device.address, timeout=60.0) as client:
             if client.is_connected:
                 print(f"Connected to {device.name}")
@@ -248,37 +299,62 @@ class NUSModemClient:
 
             else:
                 print(f"Failed to connect to {device.name}")
+        return self.data_written
 
-    def save_file_raw(self, filename):
-        mv_file_data = memoryview(self.data)
-        i = -1
-        while self.data[i] == 0x00: # Remove padded zeros at the end.
-            i -= 1
-
-        with open(filename, "wb") as file:
-            size = file.write(mv_file_data[:i+1] if i < -1 else self.data)
-        if size != self.data_size:
-            print(f"Error: {size}(file size) != {self.data_size}(spec)")
+    def save_block(self): # Write the data of a verified block; the zero padding after data_size is not written.
+        if self.use_deflate:
+            self.unpack_records(self.block_data)
         else:
-            print(f"Successfully wrote combined data to {filename}")
-
-    def crc16_arc(self, data):
-        '''crc16/arc
-        XOSS uses CRC16/ARC instead of CRC16/XMODEM.
-        '''
-        crc = 0
-        for x in data:
-            crc ^= x
-            for _ in range(8):
-                if (crc & 0x0001) > 0:
-                    crc = (crc >> 1) ^ 0xa001
-                else:
-                    crc = crc >> 1
-        return crc & 0xffff
+            self.data_written += self.file.write(self.block_data[:max(0, self.data_size - self.data_written)])
+
+    def unpack_records(self, data): # Deflate records to the file; a record may be split between blocks.
+        self.zrec.extend(data)
+        i = 0
+        while len(self.zrec) - i >= 2 and self.data_written < self.data_size:
+            header = int.from_bytes(self.zrec[i:i + 2], 'big')
+            end = i + 2 + (header & (_ZREC_LAST - 1))
+            if len(self.zrec) < end: break
+            record = bytes(self.zrec[i + 2:end])
+            self.data_written += self.file.write(zlib.decompress(record) if header & _ZREC_DEFLATE else record)
+            i = end
+        del self.zrec[:i]
+        if self.data_written >= self.data_size: self.zrec.clear() # Zero padding after the last record.
+
+async def fetch_all(target_name, max_connections):
+    # Fetch from all of the devices found in a scan, up to max_connections at once, each by a client of its own.
+    print("Scanning for Bluetooth devices...")
+    devices = [device for device in await BleakScanner.discover(timeout=10.0)
+               if device.name is not None and target_name in device.name]
+    if not devices:
+        print(f"{target_name} not found")
+        return
+    print(f"Found {len(devices)} devices: {', '.join(device.address for device in devices)}")
+    semaphore = asyncio.Semaphore(max_connections)
+
+    async def fetch(device):
+        async with semaphore:
+            try:
+                return await NUSModemClient(directory=device.address.replace(':', '')).download(device)
+            except Exception as e: # e.g. BleakError or TimeoutError in connecting; the others go on.
+                print(f"Failed to fetch from {device.address}: {e}")
+                return 0
+
+    t = time.monotonic()
+    sizes = await asyncio.gather(*(fetch(device) for device in devices))
+    t = time.monotonic() - t
+    print(f"{sum(sizes)} bytes from {sum(1 for size in sizes if size)}/{len(devices)} devices in {t:.1f} s, "
+        f"{sum(sizes) * 8 / t / 1000:.1f} kbps in total.")
 
 if __name__ == "__main__":
-    client = NUSModemClient()
+    import argparse
+    parser = argparse.ArgumentParser(description='Fetch a file from mpy-nus by YMODEM over Nordic UART Service.')
+    parser.add_argument('--all', action='store_true', help='fetch from all of the devices found, in directories by address')
+    parser.add_argument('--max-connections', type=int, default=3, help='devices connected at once with --all')
+    args = parser.parse_args()
     try:
-        asyncio.run(client.main())
+        if args.all:
+            asyncio.run(fetch_all(TARGET_NAME, args.max_connections))
+        else:
+            asyncio.run(NUSModemClient().main())
     finally:
         asyncio.new_event_loop() # Clear retained state.
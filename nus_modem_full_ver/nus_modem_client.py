@@ -8,15 +8,24 @@ import sys
 
 sys.path.append('')
 
+from micropython import const
+
 import machine
 import asyncio
 import aioble
 import bluetooth
 import os
-import gc
+import io
+import json
 from collections import deque
-import time
 from array import array
+import time
+import ble_scan
+from crc16_arc import update_at as crc16_arc_update_at
+try:
+    import deflate
+except ImportError:
+    deflate = None
 
 
 _TARGET_NAME = "mpy-nus"
@@ -24,11 +33,14 @@ _TARGET_NAME = "mpy-nus"
 _NUS_SERVICE_UUID = bluetooth.UUID("6e400001-b5a3-f393-e0a9-e50e24dcca9e")
 _NUS_RX_CHARACTERISTIC_UUID = bluetooth.UUID("6e400002-b5a3-f393-e0a9-e50e24dcca9e")
 _NUS_TX_CHARACTERISTIC_UUID = bluetooth.UUID("6e400003-b5a3-f393-e0a9-e50e24dcca9e")
+_CCCD_UUID = bluetooth.UUID(0x2902)
 
 VALUE_SOH = bytearray([0x01])                             # SOH == 128-byte data
 VALUE_STX = bytearray([0x02])                             # STX == 1024-byte data
+VALUE_BLK = bytearray([0x03])                             # Non-standard; data of the size negotiated in block zero
 VALUE_C = bytearray([0x43])                               # 'C'
-#VALUE_G = bytearray([0x47])                               # 'G'
+VALUE_G = bytearray([0x47])                               # 'G'
+VALUE_U = bytearray([0x55])                               # 'U'; non-standard; the client sends a file (upload)
 VALUE_ACK = bytearray([0x06])                             # ACK
 VALUE_NAK = bytearray([0x15])                             # NAK
 VALUE_EOT = bytearray([0x04])                             # EOT
@@ -36,6 +48,67 @@ VALUE_CAN = bytearray([0x18])                             # CAN
 
 AWAIT_NEW_DATA = bytearray(b'AwaitNewData')
 
+_IRQ_GATTC_NOTIFY = const(18)
+_IRQ_CONNECTION_UPDATE = const(27)
+
+# Connection interval asked on connecting; the peripheral may update it (_IRQ_CONNECTION_UPDATE).
+_CONN_INTERVAL_US = const(7_500)
+
+# Timeout of a block before NAK: the packets of a block at one per connection event, and two events for the reply, but
+# not less than this (for delays in the server, e.g. reading the file) nor more than 5 s; also that of the responses in
+# uploading.  A block NAKed early while still on air comes twice; in stop-and-wait, the duplicate is not answered.
+_TIMEOUT_MIN_MS = const(500)
+
+# Maximum number of blocks in flight in the streaming ('G') mode; a power of two.
+_WINDOW = const(4)
+
+# States of the block slots.
+_SLOT_FREE = const(0)
+_SLOT_BUSY = const(1) # Being filled by on_irq(), or waiting for read_block().
+_SLOT_KEPT = const(2) # Received out of order; kept until the missing blocks arrive.
+
+# Data of the blocks are placed at their offsets in the file modulo the size of the ring, and written from there.
+# The ring consists of two halves; one is written to SD while the other is filled by the IRQ.
+_FLUSH_SIZE = const(4 * 1024) # 4-16 KiB, a multiple of 1024 (and of the sector size); not less than _WINDOW * 1024.
+_RING_SIZE = const(2 * _FLUSH_SIZE)
+
+# Maximum size of data in a large block (VALUE_BLK), if offered by the server; 0 to disable.  The spare takes as much.
+# Large blocks are used only if they carry more data per packet than STX; the ring halves hold the blocks in flight.
+_BLOCK_MAX = const(_FLUSH_SIZE)
+
+# Deflate, if offered by the server; records of up to _ZCHUNK bytes (before compression) are decompressed one by one.
+_ZCHUNK = const(4096)
+_ZREC_DEFLATE = const(0x8000)
+_ZREC_LAST = const(0x4000)
+
+# Notifications queued by aioble: blocks, including block zero, are taken by on_irq() and never queued, so only the short
+# ones are, i.e. EOT, 'C'/'G' and, in uploading, ACK/NAK of the blocks in flight (_WINDOW) and one more of each.
+_NOTIFY_QUEUE = const(_WINDOW + 2)
+
+# Timestamps of the phases of the last N blocks of a file, printed as histograms at the end (ticks_trace.py); 0 to disable.
+_TRACE = const(0)
+_PH_FIRST = const(0) # The first packet of the block.
+_PH_LAST = const(1) # The last packet; the CRC of the data is computed as the packets arrive.
+_PH_CRC = const(2) # CRC compared.
+_PH_WRITE = const(3) # Saved (written to SD by a half of the ring).
+_PH_REPLY = const(4) # ACK/NAK sent, if any.
+if _TRACE:
+    from ticks_trace import PhaseTrace
+
+# The address and the handles of NUS of the peer, by the target name, kept on flash after the discovery; the next session
+# connects to the address directly (without scanning) and uses the handles (without discovery), and falls back to the
+# scan and the discovery if the peer does not connect in _DIRECT_TIMEOUT_MS or refuses the CCCD.  None to always scan.
+_PEER_CACHE = 'nus_peers.json'
+_DIRECT_TIMEOUT_MS = const(5_000)
+
+# Gap between the commands of the handshakes to a server without G/B/M in block zero (e.g. the one in the parent
+# directory); written() of aioble there misses a write arriving before the previous one was taken.
+_LEGACY_GAP_MS = const(100)
+
+# Send this file to the server instead of receiving, e.g. '/sd/config.json'; None to receive.  The blocks are sent by write
+# without response from the ring of data (_WINDOW + 1 of them), thus large blocks are up to _RING_SIZE // (_WINDOW + 1) - 5 bytes.
+_UPLOAD = None
+
 class NUSModemClient:
     def __init__(self):
         #self.lock = asyncio.Lock()
@@ -47,318 +120,804 @@ class NUSModemClient:
         self.notification_data = bytearray()
         # **Block**
         self.is_block = False
-        self.use_stx = False # True/False = STX/SOH
-        self.block_buf = bytearray(3 + 1024 + 2)                                 # Header(SOH/STX, num, ~num); data(128 or 1024 bytes); CRC16
+        self.data_sizes = array('H', (0, 128, 1024, 0)) # Size of data by the header (SOH/STX/BLK); 0 if not in use.
+        self.use_streaming = False # True/False = 'G'/'C'
+        self.window = 1 # Number of blocks in flight (given in block zero in the streaming mode).
+        self.is_skipped = False # A block was out of order in the streaming mode, or a duplicate in stop-and-wait.
+        self.is_timeout = False
+        self.ack_pending = 0 # Blocks received in order since the last ACK (streaming).
+        self.nak_sent = 0 # Blocks NAKed after the last one received in order (streaming).
+        self.ahead_high = 0 # The farthest block received out of order, relative to the next one (streaming).
+        self.cmd_buf = bytearray(2) # ACK/NAK followed by a block number in the streaming mode.
+        self.data_ring = bytearray(_RING_SIZE)                                   # Data(128, 1024 or the large size) of the blocks
+        mv_data_ring = memoryview(self.data_ring)
+        self.ring_data = [None] + [tuple(mv_data_ring[i:i + n] for i in range(0, _RING_SIZE, n)) for n in (128, 1024)] + [None] # By the header
+        self.mv_spare_data = memoryview(bytearray(max(1024, _BLOCK_MAX)))        # Data of block zero and duplicates
+        self.spare_data = [None, self.mv_spare_data[:128], self.mv_spare_data[:1024], None]
+        self.flush_size = _FLUSH_SIZE # A half of the ring in use; a multiple of the size of data in a block.
+        self.hdr_ring = memoryview(bytearray(3 * (_WINDOW + 1)))                 # Header(SOH/STX, num, ~num) and CRC16 of the blocks in flight and a spare
+        self.crc_ring = memoryview(bytearray(2 * (_WINDOW + 1)))
+        self.slot_hdr = tuple(self.hdr_ring[i * 3:(i + 1) * 3] for i in range(_WINDOW + 1))
+        self.slot_crc = tuple(self.crc_ring[i * 2:(i + 1) * 2] for i in range(_WINDOW + 1))
+        self.slot_crc_calc = array('H', bytes(2 * (_WINDOW + 1))) # CRC of the data computed as the packets arrive.
+        self.slot_data = [None] * (_WINDOW + 1)
+        self.slot_state = bytearray(_WINDOW + 1)
+        self.ready_slots = deque((), _WINDOW + 2) # Slots of the blocks completed by on_irq().
+        self.block_flag = asyncio.ThreadSafeFlag() # Set by on_irq() when a block is completed.
+        self.fill_slot = -1 # The slot being filled by on_irq(); -1 while waiting for a block header.
+        self.fill_hdr = None
+        self.fill_data = None
+        self.fill_crc = None
+        self.fill_crc_calc = 0
+        self.fill_size = 0
+        self.len_first_packet = 0 # Packets of a block are of this size except the last one.
+        self.len_last_packet = 0
+        self.slot = 0 # Index in slot_hdr/slot_data/slot_crc.
         self.block_num = 0 # Block number(0-255).
-        self.idx_block_buf = 0 # Index in block_buf.
-        self.mv_block_buf = memoryview(self.block_buf)
+        self.blocks_saved = 0 # Data blocks saved; the next one is placed at this index in the ring.
+        self.idx_block_buf = 0 # Index in the block being filled.
+        self.block_hdr = None
         self.block_size = None
         self.block_data = None
         self.block_crc = None
-        self.block_size_data_crc = (
-            (3 + 128 + 2, self.mv_block_buf[3:131], self.mv_block_buf[131:133], ), # SOH
-            (3 + 1024 + 2, self.mv_block_buf[3:-2], self.mv_block_buf[-2:], ),     # STX
-        )
         self.block_error = False
         # **File**                                                               A file is made of blocks; a block is made of packets.
         self.data_size = 0
         self.data_written = 0
         self.filename = ''
         self.is_write_mode = False
-        self.write_buf = bytearray(128 * 4)                                      # This write buffer is exclusively used in SOH blocks.
-        self.mv_write_buf = memoryview(self.write_buf)
-        self.write_buf_page = tuple(self.mv_write_buf[i * 128:(i+1) * 128] for i in range(4))
-        self.idx_write_buf = 0
-
-    async def notify_handler(self):
-        _EOT = bytes(VALUE_EOT)
-        _STX = VALUE_STX[0]
-        queue = self.tx_characteristic._notify_queue
-
-        def append_to_block_buf(data):
-            if (len_data := len(data)):
-                self.block_buf[self.idx_block_buf:self.idx_block_buf + len_data] = data
-                self.idx_block_buf += len_data
-
-        async def fill_queue(n, timeout_ms):
-            async def q():
-                while sum((len(x) for x in queue)) < n:
-                    #await asyncio.sleep_ms(10)
-                    await asyncio.sleep_ms(2)
-            try:
-                await asyncio.wait_for_ms(q(), timeout_ms)
-            except asyncio.TimeoutError:
-                pass
-
-        while True:
-            data = await self.tx_characteristic.notified()
-            if data == _EOT:                                                        # Receive EOT.
-                self.is_block = False
-                self.notification_data[:] = data
-            elif self.is_block:                                                     # Packets should be combined to make a block.
-                self.use_stx = True if data[0] == _STX else False
-                self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.use_stx)]
-                if (n := self.block_size - len(data)) > 0:
-                    await fill_queue(n, timeout_ms=150)
-                append_to_block_buf(data)
-                while len(queue) >= 1:
-                    append_to_block_buf(queue.popleft())
-                self.tx_characteristic._notify_event.clear()                        # Make sure to clear the flag.
+        self.data_received = 0 # Bytes in the ring up to the last block saved, i.e. written or to be written.
+        self.file = None # Kept open during the transfer.
+        self.us_write = 0 # Time spent in writing to the file.
+        # **Deflate** Records (2-byte header, data) in the data of blocks.
+        self.use_deflate = False
+        self.zhdr = bytearray(2) # Flags and length.
+        self.zrec = bytearray(_ZCHUNK)
+        self.zout = bytearray(1024) # Decompressed.
+        self.zidx = 0 # Index in the record including the header.
+        self.zlen = 0
+        self.connection = None
+        self.conn_handle = None
+        self.conn_interval_us = _CONN_INTERVAL_US # As asked, until updated.
+        self.conn_latency = 0
+        self.is_conn_updated = False # The parameters above are those reported by _IRQ_CONNECTION_UPDATE.
+        self.supervision_timeout_ms = 0 # Unknown, until updated.
+        self.block_timeout_ms = 5_000
+        self.is_legacy_peer = False # Without G/B/M in block zero; see _LEGACY_GAP_MS.
+        self.ticks_ready = 0 # Connected, or the previous file completed; the latency to the first block is measured from this.
+        self.first_block_ms = None
+        self.ready_ms = None # From the start of main() to the subscription (scan or direct connection, and discovery).
+        self.conn_irq_handler = self.on_connection_update # Added to aioble in main(), and removed at the end.
+        self.notify_queue_depth = _NOTIFY_QUEUE
+        self.notify_dropped = 0 # Notifications discarded in a file; by on_irq(), or by the full queue of aioble.
+        self.trace = PhaseTrace(('first', 'last', 'crc', 'write', 'reply'), _WINDOW + 1, _TRACE) if _TRACE else None
+        # **Upload** Blocks (header, data, CRC) laid out in data_ring; sent by sequence number (go-back-N).
+        self.send_type = VALUE_SOH[0]
+        self.send_slots = None # (block, data) by the sequence number modulo window + 1.
+        self.seq_base = 1 # The oldest block not acknowledged yet.
+        self.seq_next = 1 # The next block to be sent.
+        self.seq_high = 1 # The next block never sent.
+        self.seq_filled = 0 # The last block read ahead into the ring.
+        self.seq_rewind = 0 # The block NAKed by the server; sent again from there.
+        self.is_eof = False
+        self.ticks_progress = 0 # The last block sent or acknowledged.
+        self.blocks_sent = 0 # Including those sent again.
+        self.blocks_resent = 0
+
+    def on_irq(self, event, data): # Inserted before the IRQ handler of aioble.client while fetching a file.
+        if event == _IRQ_GATTC_NOTIFY and self.is_block:
+            conn_handle, value_handle, notify_data = data
+            if conn_handle == self.conn_handle and value_handle == self.tx_characteristic._value_handle:
+                self.on_packet(notify_data)
+                return True # Consumed; the packet is not copied to the queue of aioble.
+        elif event == _IRQ_GATTC_NOTIFY and len(self.tx_characteristic._notify_queue) >= self.notify_queue_depth:
+            if data[0] == self.conn_handle and data[1] == self.tx_characteristic._value_handle:
+                self.notify_dropped += 1 # aioble drops the oldest one.
+        # Other events and messages/responses go to aioble.
+
+    def on_connection_update(self, event, data): # Parameters updated by either side; always passed to aioble.
+        if event == _IRQ_CONNECTION_UPDATE and data[0] == self.conn_handle:
+            _, conn_interval, self.conn_latency, supervision_timeout, status = data
+            if status == 0:
+                self.conn_interval_us = conn_interval * 1250
+                self.supervision_timeout_ms = supervision_timeout * 10
+                self.is_conn_updated = True
+                print(f'Connection updated: interval {self.conn_interval_us / 1000} ms, latency {self.conn_latency}, '
+                    f'supervision timeout {self.supervision_timeout_ms} ms.')
+
+    def on_packet(self, data): # The data is a memoryview valid only during the IRQ; copied once to the block.
+        if len(data) == 1 and data[0] == VALUE_EOT[0]:                              # Receive EOT.
+            self.is_block = False
+            self.notification_data[:] = data
+            self.block_flag.set()
+        elif ((self.fill_slot < 0 or self.len_last_packet < self.len_first_packet # After the last packet of a truncated block,
+                or len(data) > self.fill_size - self.idx_block_buf)                 # or too long for the rest; otherwise this is data.
+                and len(data) >= 3 and data[0] <= VALUE_BLK[0] and self.data_sizes[data[0]] and data[1] ^ data[2] == 0xFF): # The first packet of a block.
+            if self.fill_slot >= 0: self.slot_state[self.fill_slot] = _SLOT_FREE  # Discard a truncated block, if any.
+            slot = data[1] % self.window if self.use_streaming else 0
+            if self.slot_state[slot] != _SLOT_FREE: slot = _WINDOW                 # Use the spare for a duplicate.
+            if self.slot_state[slot] != _SLOT_FREE:                                 # No room; the block is NAKed later.
+                self.fill_slot = -1
+                self.notify_dropped += 1
+                return
+            block_type = data[0]
+            ahead = (data[1] - self.blocks_saved - 1) % 256
+            if self.is_write_mode and slot < _WINDOW and ahead < self.window:       # At its offset in the file.
+                ring_data = self.ring_data[block_type]
+                self.fill_data = ring_data[(self.blocks_saved + ahead) % len(ring_data)]
             else:
-                self.notification_data[:] = data                                    # Other messages/responses.
-            await asyncio.sleep(0)
-
-    async def clear_notify_queue(self):
-        queue = self.tx_characteristic._notify_queue
-        await asyncio.sleep_ms(200)
-        while len(queue) >= 1:
-            _ = queue.popleft()
-        self.tx_characteristic._notify_event.clear()                                # Make sure to clear the flag.
+                self.fill_data = self.spare_data[block_type]
+            self.fill_slot = slot
+            if self.trace: self.trace.stage(slot, _PH_FIRST)
+            self.slot_state[slot] = _SLOT_BUSY
+            self.slot_data[slot] = self.fill_data
+            self.fill_hdr = self.slot_hdr[slot]
+            self.fill_crc = self.slot_crc[slot]
+            self.fill_size = 3 + self.data_sizes[block_type] + 2
+            self.idx_block_buf = 0
+            self.fill_crc_calc = 0
+            self.len_first_packet = len(data)
+            self.fill_block(data)
+        elif self.fill_slot >= 0:                                                   # Packets should be combined to make a block.
+            self.fill_block(data)
+        else:                                                                       # Resynchronize to the next block after a lost packet.
+            self.notify_dropped += 1
+
+    def fill_block(self, data): # Copy a packet to the header, data and CRC of the slot; complete at fill_size bytes.
+        idx = self.idx_block_buf
+        idx_crc = self.fill_size - 2
+        n = min(len(data), self.fill_size - idx) # Never beyond the block.
+        i = 0
+        if idx < 3:
+            i = 3 - idx
+            self.copy_bytes(self.fill_hdr, idx, data, 0, i)
+        if (len_data := min(n, idx_crc - idx) - i) > 0:
+            self.copy_bytes(self.fill_data, idx + i - 3, data, i, len_data)
+            self.fill_crc_calc = crc16_arc_update_at(self.fill_crc_calc, data, i, len_data)
+            i += len_data
+        if n > i:
+            self.copy_bytes(self.fill_crc, idx + i - idx_crc, data, i, n - i)
+        self.idx_block_buf = idx + n
+        self.len_last_packet = len(data)
+        if self.idx_block_buf >= self.fill_size:
+            self.slot_crc_calc[self.fill_slot] = self.fill_crc_calc
+            if self.trace: self.trace.stage(self.fill_slot, _PH_LAST)
+            self.ready_slots.append(self.fill_slot)
+            self.fill_slot = -1
+            self.block_flag.set()
+
+    def reset_slots(self):
+        self.fill_slot = -1
+        while len(self.ready_slots) >= 1:
+            _ = self.ready_slots.popleft()
+        self.slot_state[:] = bytes(len(self.slot_state))
+
+    def select_slot(self, slot):
+        self.slot = slot
+        self.block_hdr = self.slot_hdr[slot]
+        self.block_data = self.slot_data[slot]
+        self.block_crc = self.slot_crc[slot]
+        self.block_size = 3 + self.data_sizes[self.block_hdr[0]] + 2
+
+    def set_large_size(self, size): # Lay out large blocks of the size in the ring; an even number of them.
+        self.data_sizes[VALUE_BLK[0]] = size
+        self.flush_size = _FLUSH_SIZE
+        if size:
+            n = _RING_SIZE // size // 2
+            mv_data_ring = memoryview(self.data_ring)
+            self.ring_data[VALUE_BLK[0]] = tuple(mv_data_ring[i * size:(i + 1) * size] for i in range(2 * n))
+            self.spare_data[VALUE_BLK[0]] = self.mv_spare_data[:size]
+            self.flush_size = n * size
+
+    def set_notify_queue(self): # See _NOTIFY_QUEUE.
+        self.tx_characteristic._notify_queue = deque((), self.notify_queue_depth)
+
+    def set_block_timeout(self, data_size): # See _TIMEOUT_MIN_MS.
+        payload = self.mtu_size - 3
+        n_packets = (3 + data_size + 2 + payload - 1) // payload
+        self.block_timeout_ms = min(5_000, max(_TIMEOUT_MIN_MS, (n_packets + 2) * self.conn_interval_us // 1000))
+
+    def choose_large_size(self, size_max): # A multiple of the ATT payload minus 5, if it carries more per packet than STX.
+        payload = self.mtu_size - 3
+        size_max = min(size_max, _BLOCK_MAX, _RING_SIZE // (2 * self.window))
+        n_packets = (size_max + 5) // payload
+        size = n_packets * payload - 5
+        n_packets_stx = (3 + 1024 + 2 + payload - 1) // payload
+        return size if self.mtu_size > 23 and size * n_packets_stx > 1024 * n_packets else 0
 
     async def discover_device(self, target_name):
-        # Scan for 20 seconds, in active mode, with very low interval/window (to maximise detection rate).
-        async with aioble.scan(duration_ms=20_000, interval_us=30000, window_us=30000, active=True) as scanner:
-            async for result in scanner:
-                # See if it matches target_name.
-                if (name := result.name()) is not None and target_name in name:
-                    print(f"Found target device: {name} - {result.device}")
-                    return result.device
+        # Wait for 20 seconds for a name starting with target_name in the shared scan (ble_scan.py, in the parent directory).
+        if device := await ble_scan.shared.find(name=target_name, timeout_ms=20_000):
+            print(f"Found target device: {device}")
+            return device
 
         print(f"Device with name {target_name} not found.")
         return None
 
-    async def send_cmd(self, char, value, delay_ms):
+    async def send_cmd(self, char, value): # The handshake waits for the responses, not by delays.
         try:
             await char.write(value, False)
         except Exception as e:
             print(f"Failed to write value to characteristic: {e}")
-        await asyncio.sleep_ms(delay_ms)
 
-    async def read_block_zero(self):
+    async def legacy_gap(self): # Before a command following another one; see _LEGACY_GAP_MS.
+        if self.is_legacy_peer: await asyncio.sleep_ms(_LEGACY_GAP_MS)
+
+    async def read_block_zero(self, value=VALUE_C): # 'C', or NAK to ask for block zero again; one request for each.
         self.block_num = -1
-        self.idx_block_buf = 0
-        self.is_block = True
         self.block_error = False
-        await self.send_cmd(self.rx_characteristic, VALUE_C, 100)                     # Send 'C'.
+        self.use_streaming = False
+        self.window = 1
+        self.reset_slots()
+        self.is_block = True
+        await self.send_cmd(self.rx_characteristic, value)                            # Send 'C' (or NAK on error).
         await self.read_block()
+        while not self.is_block: # EOT of the previous file, sent again by the server; block zero follows.
+            self.is_block = True
+            await self.read_block()
 
     async def read_block(self):
-        # [ESP32] A cleaner implementation with asyncio.Event() than this polling function lead to a decreased throughput.
-        async def check_block_buf():
-            while self.is_block and self.idx_block_buf == 0:
-                #await asyncio.sleep_ms(10)
-                await asyncio.sleep_ms(2)
-            await asyncio.sleep_ms(0)
-            block_size = self.block_size
-            while self.is_block and self.idx_block_buf < block_size: # block_size = 133/1029 bytes in SOH/STX (one block)
-                #await asyncio.sleep_ms(10)
-                await asyncio.sleep_ms(2)
-
-        def write_to_buf(data):
-            if self.use_stx: # Do not use write_buf in STX.
-                if self.idx_write_buf > 0: flush_write_buf()
-                self.save_chunk_raw(data)
-            else:
-                self.write_buf_page[self.idx_write_buf][:] = data
-                self.idx_write_buf += 1
-                if self.idx_write_buf == 4:
-                    self.save_chunk_raw(self.write_buf)
-                    self.idx_write_buf = 0
-                elif (self.data_written + self.block_size - 5) == self.data_size:
-                    flush_write_buf()
-            return self.block_size - 5
-
-        def flush_write_buf():
-            self.save_chunk_raw(self.mv_write_buf[:self.idx_write_buf * 128])
-            self.idx_write_buf = 0
-
+        # [ESP32] Blocks are combined by on_irq() in the notification path; this waits for one without polling.
+        self.is_skipped = False
+        self.is_timeout = False
         try:
-            await asyncio.wait_for(check_block_buf(), timeout=5) # Set client/server timeouts at 5/10 sec. 
+            while self.is_block and len(self.ready_slots) == 0:
+                await asyncio.wait_for_ms(self.block_flag.wait(), self.block_timeout_ms) # Server timeout is 10 sec.
             if not self.is_block: return # The 1st EOT may arrive very late.
-            if int.from_bytes(self.block_crc, 'big') != self.crc16_arc(self.block_data):
+            self.select_slot(slot := self.ready_slots.popleft())
+            is_crc_error = int.from_bytes(self.block_crc, 'big') != self.slot_crc_calc[slot]
+            if self.trace:
+                self.trace.stage(slot, _PH_CRC)
+                self.trace.commit(slot)
+            if is_crc_error:
                 self.block_error = True
-                print(f'Size: {self.idx_block_buf}')
-                print(self.block_buf[:self.block_size])
+                print(bytes(self.block_hdr) + bytes(self.block_data) + bytes(self.block_crc))
+            elif ahead := (self.block_hdr[1] - self.block_num - 1) % 256:
+                if self.use_streaming:
+                    self.is_skipped = True # Out of order; keep it until the missing blocks arrive.
+                    if ahead < self.window and slot < _WINDOW:
+                        self.slot_state[slot] = _SLOT_KEPT
+                        self.ahead_high = max(self.ahead_high, ahead)
+                elif ahead == 255: # A duplicate after NAK of a late block; an ACK would be taken for the next block.
+                    self.is_skipped = True
+                    print(f'Unexpected block: {self.block_num} -> {self.block_hdr[1]}')
+                else: # Not expected from the server; NAK.
+                    print(f'Lost block: {self.block_num} -> {self.block_hdr[1]}')
+                    self.block_error = True
             else:
-                if self.is_write_mode:                                                    # Blocks should be combined to make a file.
-                    if (self.data_written + self.block_size - 5) <= self.data_size:
-                        self.data_written += write_to_buf(self.block_data)
-                    else:
-                        if self.idx_write_buf > 0: flush_write_buf()
-                        mv_block_data = memoryview(self.block_data)
-                        i = -1
-                        while self.block_data[i] == 0x00: # Remove padded zeros at the end.
-                            i -= 1
-                        self.data_written += self.save_chunk_raw(mv_block_data[:i+1])
-                if self.block_buf[1] == (self.block_num + 1) % 256:
-                    if self.block_error: print(f'Fixed error in block{self.block_buf[1]}.')
-                else:
-                    print(f'Unexpected block: {self.block_num} -> {self.block_buf[1]}')
-                self.block_num = self.block_buf[1]
+                if self.is_write_mode: self.save_block()                                  # Blocks should be combined to make a file.
+                if self.trace: self.trace.mark(_PH_WRITE)
+                if self.block_error: print(f'Fixed error in block{self.block_hdr[1]}.')
+                self.block_num = self.block_hdr[1]
                 self.block_error = False
+                if self.use_streaming: self.save_blocks_present()
+            if self.slot_state[slot] == _SLOT_BUSY: self.slot_state[slot] = _SLOT_FREE # Ready for the next block.
         except asyncio.TimeoutError:
             self.block_error = True
-            print('Timeout 5 sec.')
-        # Prepare for the next data block.
-        self.idx_block_buf = 0
-
-    async def end_of_transfer(self):
-        # The first EOT was received already.
-        await asyncio.sleep_ms(100) # This avoids NAK to be sent too fast.
-        self.notification_data = AWAIT_NEW_DATA
-        await self.send_cmd(self.rx_characteristic, VALUE_NAK, 100) # Send NAK.
-        await self.wait_until_data(self.tx_characteristic)                                   # Receive the second EOT.
-        await asyncio.sleep_ms(100) # This avoids ACK to be sent too fast.
-        self.notification_data = AWAIT_NEW_DATA
-        await self.send_cmd(self.rx_characteristic, VALUE_ACK, 100) # Send ACK.
-
-    async def fetch_file(self):
+            self.is_timeout = True
+            print(f'Timeout {self.block_timeout_ms} ms.')
+
+    def save_block(self): # The data are in place in the ring already; write them by a half of the ring.
+        self.blocks_saved += 1
+        if self.use_deflate: # Decompress the records now; data_written counts the decompressed bytes.
+            self.data_received += self.block_size - 5
+            self.unpack_records(self.block_data)
+            return
+        self.data_received = min(self.data_received + self.block_size - 5, self.data_size) # Remove padded zeros at the end.
+        if self.data_received - self.data_written >= self.flush_size or self.data_received == self.data_size:
+            idx = self.data_written % (2 * self.flush_size) # Never wraps around, as flush_size is a multiple of the block.
+            self.data_written += self.save_chunk_raw(
+                memoryview(self.data_ring)[idx:idx + self.data_received - self.data_written])
+
+    def unpack_records(self, data): # The header of a record may be split between blocks, as well as its data.
+        i = 0
+        n = len(data)
+        while i < n and self.data_written < self.data_size:
+            if self.zidx < 2:
+                self.zhdr[self.zidx] = data[i]
+                i += 1
+                self.zidx += 1
+                if self.zidx == 2:
+                    self.zlen = (self.zhdr[0] << 8 | self.zhdr[1]) & (_ZREC_LAST - 1)
+            else:
+                k = min(n - i, 2 + self.zlen - self.zidx)
+                self.zrec[self.zidx - 2:self.zidx - 2 + k] = data[i:i + k]
+                i += k
+                self.zidx += k
+            if self.zidx == 2 + self.zlen:
+                self.write_record()
+                self.zidx = 0
+        # The rest is zero padding after the last record.
+
+    def write_record(self):
+        rec = memoryview(self.zrec)[:self.zlen]
+        if self.zhdr[0] << 8 & _ZREC_DEFLATE:
+            d = deflate.DeflateIO(io.BytesIO(rec), deflate.ZLIB)
+            while nbytes := d.readinto(self.zout):
+                self.data_written += self.save_chunk_raw(memoryview(self.zout)[:nbytes])
+        else:
+            self.data_written += self.save_chunk_raw(rec)
+
+    def save_blocks_present(self): # Blocks kept in the ring may follow the one just saved (streaming).
+        advanced = 1
+        while self.slot_state[slot := (self.block_num + 1) % self.window] == _SLOT_KEPT:
+            self.select_slot(slot)
+            self.save_block()
+            self.block_num = self.block_hdr[1]
+            self.slot_state[slot] = _SLOT_FREE
+            advanced += 1
+        self.ack_pending += advanced
+        self.nak_sent = max(0, self.nak_sent - advanced)
+        self.ahead_high = max(0, self.ahead_high - advanced)
+
+    async def respond_streaming(self): # ACK every window/2 blocks received in order; NAK missing blocks by number.
+        if self.is_timeout:                                                               # Ask again for all of the missing blocks.
+            self.cmd_buf[0] = VALUE_ACK[0]
+            self.cmd_buf[1] = self.block_num
+            await self.send_cmd(self.rx_characteristic, self.cmd_buf)                 # The last ACK may have been lost.
+            start, end = 0, max(1, self.ahead_high)
+        elif self.is_skipped:                                                             # Missing blocks before the one kept.
+            start, end = self.nak_sent, self.ahead_high
+        else:
+            if not self.block_error and (
+                    self.ack_pending >= max(1, self.window // 2) or self.data_written >= self.data_size):
+                self.ack_pending = 0
+                self.cmd_buf[0] = VALUE_ACK[0]
+                self.cmd_buf[1] = self.block_num
+                await self.send_cmd(self.rx_characteristic, self.cmd_buf)             # Send ACK and block number.
+            return
+        self.nak_sent = max(self.nak_sent, end)
+        self.cmd_buf[0] = VALUE_NAK[0]
+        for i in range(start, end):
+            if self.slot_state[(num := (self.block_num + 1 + i) % 256) % self.window] != _SLOT_KEPT:
+                self.cmd_buf[1] = num
+                await self.send_cmd(self.rx_characteristic, self.cmd_buf)             # Send NAK and block number.
+
+    async def end_of_transfer(self): # The first EOT was received already.  True if the second one was acknowledged.
+        for _ in range(3): # NAK again if the NAK or the second EOT was lost.
+            await self.legacy_gap()
+            await self.send_cmd(self.rx_characteristic, VALUE_NAK)                        # Send NAK.
+            while (data := await self.wait_for_response(self.block_timeout_ms)) is not None:
+                if data == VALUE_EOT:                                                      # Receive the second EOT.
+                    await self.legacy_gap()
+                    await self.send_cmd(self.rx_characteristic, VALUE_ACK)                # Send ACK.
+                    return True
+                # Packets of blocks sent again before the first EOT; skipped.
+        print('No second EOT.')
+        return False
+
+    async def fetch_file(self): # Returns True if the next file of a batch may follow.
         self.notification_data = AWAIT_NEW_DATA
 
         self.is_write_mode = False                                                         # Do not write block 0
-        notify_handler_task = asyncio.create_task(self.notify_handler())
-        await asyncio.sleep(1)
+        self.set_large_size(0)
+        irq_handler = self.on_irq
+        aioble.core._irq_handlers.insert(0, irq_handler)                                   # Combine packets to make blocks on notification.
         retries = 3
-        while retries > 0:
-            await self.read_block_zero() # Block 0 consists of name and size of the file.
+        value = VALUE_C
+        while retries > 0 and self.connection.is_connected(): # A server without batch disconnects after the first file.
+            await self.read_block_zero(value) # Block 0 consists of name and size of the file.
             if self.block_error:
                 retries -= 1
-                await self.clear_notify_queue()
-                await self.send_cmd(self.rx_characteristic, VALUE_NAK, 100)               # Send NAK on error.
+                value = VALUE_NAK                                                          # NAK on error.
             else:
                 break
         if retries == 0: # Too many errors in reading block zero; cancel transport.
-            await self.send_cmd(self.rx_characteristic, VALUE_CAN, 100)                   # Send CAN (cancel).
-            notify_handler_task.cancel()
-            return
+            await self.send_cmd(self.rx_characteristic, VALUE_CAN)                        # Send CAN (cancel).
+        if retries == 0 or not self.connection.is_connected():
+            aioble.core._irq_handlers.remove(irq_handler)
+            return False
 
         file_informations = bytes(self.block_data).rstrip(b'\x00').decode('utf-8').split()
+        if not file_informations:                                                          # Empty block zero; the end of the batch.
+            await self.send_cmd(self.rx_characteristic, VALUE_ACK)                        # Send ACK.
+            aioble.core._irq_handlers.remove(irq_handler)
+            print('End of batch.')
+            return False
+
         self.filename = file_informations[0]
         self.data_size = int(file_informations[1])
-        if self.filename in os.listdir('/sd'):
-            os.rename(f'/sd/{self.filename}', f'/sd/{self.filename}.old')
+        large_max = 0
+        mtime = ''
+        self.use_deflate = False
+        for option in file_informations[2:]:
+            if option[0] == 'G': # Streaming mode is available.
+                self.use_streaming = True
+                window = min(int(option[1:]), _WINDOW)
+                while self.window * 2 <= window: self.window *= 2 # A power of two, as block numbers wrap at 256.
+            elif option[0] == 'B': # Large blocks of data up to N bytes are available.
+                large_max = int(option[1:])
+            elif option[0] == 'M': # Modification time of the file; resume an interrupted transfer of the same file.
+                mtime = option[1:]
+            elif option[0] == 'Z': # Records of deflate of up to N bytes are available.
+                self.use_deflate = deflate is not None and int(option[1:]) <= _ZCHUNK
+        self.is_legacy_peer = not (self.use_streaming or large_max or mtime)
+        self.set_large_size(large_size := self.choose_large_size(large_max) if large_max else 0)
+        data_size = large_size or (1024 if self.mtu_size > 23 else 128) # SOH/STX by MTU, as the server does.
+        self.set_block_timeout(data_size)
+        print(f'Blocks of {data_size} bytes in packets of {self.mtu_size - 3} bytes; timeout {self.block_timeout_ms} ms.')
+        identity = f'{self.data_size} {mtime}'
+        offset = self.resume_offset(identity) if mtime else 0
+        if offset:
+            print(f'Resume from {offset}.')
+            self.data_size -= offset # The rest of the file.
+        else:
+            if self.filename in os.listdir('/sd'):
+                os.rename(f'/sd/{self.filename}', f'/sd/{self.filename}.old')
+            if mtime:
+                with open(f'/sd/{self.filename}.resume', 'w') as f:                     # Kept until the transfer completes.
+                    f.write(identity)
 
         print(time.localtime())
-        await self.send_cmd(self.rx_characteristic, VALUE_ACK, 100)                       # Send ACK.
-        await self.send_cmd(self.rx_characteristic, VALUE_C, 100)                         # Send 'C'.
-
         # Blocks of num>=1 should be combined to obtain the file.
         self.is_write_mode = True
+        self.blocks_saved = 0
+        self.first_block_ms = None
+        self.data_received = 0
         self.data_written = 0
-        self.idx_write_buf = 0
-        while self.is_block:                                                              # Receive EOT to exit this loop.
-            await self.read_block()
-            if not self.is_block: break # The 1st EOT may arrive very late.
-            if self.block_num % 128 == 0: gc.collect()
-            if self.block_error:
-                await self.clear_notify_queue()
-                #await self.send_cmd(self.rx_characteristic, VALUE_NAK, 10)               # Send NAK on error.
-                await self.send_cmd(self.rx_characteristic, VALUE_NAK, 2)               # Send NAK on error.
+        self.us_write = 0
+        self.zidx = 0
+        self.notify_dropped = 0
+        if self.trace: self.trace.reset()
+        self.file = open(f'/sd/{self.filename}', 'ab' if offset else 'wb')
+        try:
+            await self.send_cmd(self.rx_characteristic, VALUE_ACK)                        # Send ACK.
+            ticks_start = time.ticks_ms()
+            options = f' B{large_size}' if large_size else ''                             # and the size of large blocks,
+            options += f' R{offset}' if offset else ''                                    # and the offset to resume from,
+            options += ' Z' if self.use_deflate else ''                                   # and deflate.
+            await self.legacy_gap()
+            if self.use_streaming:
+                self.ack_pending = self.nak_sent = self.ahead_high = 0
+                await self.send_cmd(self.rx_characteristic, bytes(f'G{self.window}{options}', 'utf-8')) # Send 'G' and the window.
             else:
-                #await self.send_cmd(self.rx_characteristic, VALUE_ACK, 10)               # Send ACK.
-                await self.send_cmd(self.rx_characteristic, VALUE_ACK, 2)               # Send ACK.
-        notify_handler_task.cancel()
+                await self.send_cmd(self.rx_characteristic, bytes(f'C{options}', 'utf-8')) # Send 'C'.
+
+            while self.is_block and self.connection.is_connected():                      # Receive EOT to exit this loop.
+                await self.read_block()
+                if not self.is_block: break # The 1st EOT may arrive very late.
+                if self.first_block_ms is None and self.blocks_saved:
+                    self.first_block_ms = time.ticks_diff(time.ticks_ms(), self.ticks_ready)
+                    print(f'First block in {self.first_block_ms} ms.')
+                if self.use_streaming:
+                    await self.respond_streaming()
+                elif self.is_skipped:                                                      # Not answered; see read_block().
+                    pass
+                elif self.block_error:
+                    await self.send_cmd(self.rx_characteristic, VALUE_NAK)                # Send NAK on error.
+                else:
+                    await self.send_cmd(self.rx_characteristic, VALUE_ACK)                # Send ACK.
+                if self.trace and not self.is_timeout: self.trace.mark(_PH_REPLY)
+            t_ms = max(1, time.ticks_diff(time.ticks_ms(), ticks_start))
+        finally:
+            self.file.close()
+        aioble.core._irq_handlers.remove(irq_handler)                                     # Back to aioble.
+        if not self.connection.is_connected():
+            print(f'Disconnected at {self.data_written + offset}; the transfer resumes from there next time.')
+            return False
         await self.end_of_transfer()
+        self.ticks_ready = time.ticks_ms() # The next file in a batch.
         if self.data_written != self.data_size:
             print(f"Error: {self.data_written}(file size) != {self.data_size}(spec)")
         else:
             print(f"Successfully wrote combined data to {self.filename}")
+            if mtime:
+                os.remove(f'/sd/{self.filename}.resume')
+        t_write_ms = self.us_write // 1000
+        print(f'Throughput: {self.data_written * 8 / t_ms:.1f} kbps in {t_ms} ms, '
+            f'{self.data_written * 8 / max(1, t_ms - t_write_ms):.1f} kbps without writing to SD ({t_write_ms} ms).')
+        print(f'Notifications dropped: {self.notify_dropped} (queue of {self.notify_queue_depth}).')
+        if self.use_deflate: # The throughput above is the effective one, i.e. of the data decompressed.
+            print(f'Deflate: {self.data_received} bytes in blocks for {self.data_written} bytes, '
+                f'{self.data_received * 8 / t_ms:.1f} kbps on the link.')
+        if self.trace: self.trace.dump()
         print(time.localtime())
+        return True
+
+    def resume_offset(self, identity): # Size of the file received partly, if the transfer of the same file was interrupted.
+        try:
+            with open(f'/sd/{self.filename}.resume') as f:
+                if f.read() == identity:
+                    return os.stat(f'/sd/{self.filename}')[6]
+        except OSError:
+            pass
+        return 0
+
+    def set_send_slots(self, block_type, data_size): # Lay out the blocks to send in the ring of data (upload).
+        self.send_type = block_type
+        self.block_size = n = 3 + data_size + 2
+        mv_data_ring = memoryview(self.data_ring)
+        self.send_slots = tuple((mv, mv[3:-2]) for mv in (mv_data_ring[i * n:(i + 1) * n] for i in range(_WINDOW + 1)))
+
+    def upload_header(self, filepath): # Block zero, as the server makes it for downloads.
+        header = f"{filepath.split('/')[-1]} {os.stat(filepath)[6]} G{_WINDOW}"
+        if _BLOCK_MAX:
+            header += f' B{min(_BLOCK_MAX, _RING_SIZE // (_WINDOW + 1) - 5)}'
+        return bytes(header, 'utf-8')
+
+    def construct_send_block(self, slot, num, nbytes): # Zero padding, header and CRC of the data in the slot.
+        block, data = self.send_slots[slot]
+        for i in range(nbytes, len(data)): data[i] = 0x00
+        block[0] = self.send_type
+        block[1] = num
+        block[2] = 0xFF ^ num
+        crc = crc16_arc_update_at(0, block, 3, len(data))
+        block[-2] = crc >> 8
+        block[-1] = crc & 0xFF
+
+    def read_ahead(self, f, seq): # Read and construct the block in its slot in advance; True if it is ready (upload).
+        if self.seq_filled < seq and not self.is_eof:
+            slot = seq % (self.window + 1)
+            if nbytes := f.readinto(self.send_slots[slot][1]):
+                self.construct_send_block(slot, seq % 256, nbytes)
+                self.seq_filled = seq
+            else:
+                self.is_eof = True
+        return self.seq_filled >= seq
+
+    async def write_block(self, block): # Send a block through packets by write without response.
+        payload = self.mtu_size - 3
+        for idx in range(0, len(block), payload):
+            while self.connection.is_connected():
+                try:
+                    await self.rx_characteristic.write(block[idx:idx + payload], False)
+                    break
+                except OSError: # No buffer left in the stack.
+                    await asyncio.sleep_ms(2)
+            await asyncio.sleep_ms(0)
+        self.blocks_sent += 1
 
-    async def wait_until_data(self, char):
+    async def wait_for_response(self, timeout_ms=None): # A notification from the server while sending; None on timeout.
+        # Not by notified(); aioble waits on its flag with one item left, and the flag may have been cleared by the wake
+        # for the previous one (e.g. 'G' right after ACK).
+        queue = self.tx_characteristic._notify_queue
+        event = self.tx_characteristic._notify_event
         try:
-            self.notification_data[:] = await char.notified(timeout_ms=10_000)
+            while not queue:
+                await (asyncio.wait_for_ms(event.wait(), timeout_ms) if timeout_ms else event.wait())
         except asyncio.TimeoutError:
-                print(f"Something went wrong. No new notification data.")
+            return None
+        return queue.popleft()
 
-    async def main(self):
-        device = await self.discover_device(_TARGET_NAME)
-        if not device:
-            print(f"{_TARGET_NAME} not found")
-            return
+    async def upload_response_handler(self): # ACK/NAK followed by a block number (upload).
+        _ACK = VALUE_ACK[0]
+        _NAK = VALUE_NAK[0]
+        while True:
+            data = await self.wait_for_response()
+            if len(data) != 2: continue
+            seq = self.seq_base + ((data[1] - self.seq_base) % 256) # Block number to sequence number.
+            if seq >= self.seq_high: continue # Stale response.
+            if data[0] == _ACK: # Cumulative; blocks up to this were received.
+                self.seq_base = seq + 1
+                self.ticks_progress = time.ticks_ms()
+            elif data[0] == _NAK and seq >= self.seq_base: # Blocks before this were received; this is missing.
+                self.seq_base = seq
+                self.seq_rewind = seq
+
+    async def send_file_blocks(self, f): # Keep window blocks in flight; go back to the block NAKed or not acknowledged.
+        self.seq_base = self.seq_next = self.seq_high = 1
+        self.seq_filled = self.seq_rewind = 0
+        self.is_eof = False
+        self.ticks_progress = time.ticks_ms()
+        response_handler_task = asyncio.create_task(self.upload_response_handler())
+        try:
+            while self.connection.is_connected():
+                if self.seq_rewind:
+                    print(f'NAK: block{self.seq_rewind % 256}')
+                    self.blocks_resent += max(0, self.seq_next - self.seq_rewind)
+                    self.seq_next, self.seq_rewind = self.seq_rewind, 0
+                self.seq_next = max(self.seq_next, self.seq_base)
+                if self.seq_next - self.seq_base < self.window and self.read_ahead(f, self.seq_next):
+                    await self.write_block(self.send_slots[self.seq_next % (self.window + 1)][0])
+                    self.seq_next += 1
+                    self.seq_high = max(self.seq_high, self.seq_next)
+                    self.ticks_progress = time.ticks_ms()
+                elif self.seq_base == self.seq_next: # All of the blocks were acknowledged.
+                    break
+                elif time.ticks_diff(time.ticks_ms(), self.ticks_progress) > self.block_timeout_ms:
+                    print(f'Timeout {self.block_timeout_ms} ms.')
+                    self.blocks_resent += self.seq_next - self.seq_base
+                    self.seq_next = self.seq_base
+                    self.ticks_progress = time.ticks_ms()
+                else: # Read the next block ahead while waiting for ACK.
+                    self.read_ahead(f, self.seq_next)
+                    await asyncio.sleep_ms(2)
+        finally:
+            response_handler_task.cancel()
+
+    async def upload_file(self, filepath): # Send a file to the server ('U') in blocks, as the server does; True if done.
+        await self.send_cmd(self.rx_characteristic, VALUE_U)                             # Send 'U'.
+        self.set_send_slots(VALUE_SOH[0], 128)
+        header = self.upload_header(filepath)
+        block, data = self.send_slots[0]
+        data[:len(header)] = header
+        self.construct_send_block(0, 0, len(header))
+        response = await self.wait_for_response(10_000)                                     # Receive 'C'.
+        retries = 3
+        while retries > 0 and response == bytes(VALUE_C):
+            await self.write_block(block)                                                  # Send block zero.
+            response = await self.wait_for_response(10_000)                                # Receive ACK, or NAK and 'C'.
+            if response == bytes(VALUE_NAK):
+                response = await self.wait_for_response(10_000)
+            retries -= 1
+        reply = None
+        if response and response[:1] == bytes(VALUE_G): # ACK was lost; 'G' follows it.
+            response, reply = bytes(VALUE_ACK), response
+        if response != bytes(VALUE_ACK):
+            print('Too many errors.')
+            return False
+        reply = reply or await self.wait_for_response(10_000)                               # Receive 'G' and the window, or 'C'.
+        if not reply or reply[:1] not in (bytes(VALUE_C), bytes(VALUE_G)):
+            print(f'Unexpected reply: {reply}')
+            return False
+        print(f"'{bytes(reply).decode()}' was received.")
+        options = bytes(reply).decode().split()
+        self.window = min(int(options[0][1:]), _WINDOW) if reply[:1] == bytes(VALUE_G) else 1
+        large_size = 0
+        for option in options[1:]:
+            if option[0] == 'B':
+                large_size = int(option[1:])
+        if large_size:
+            self.set_send_slots(VALUE_BLK[0], large_size)
+        elif self.mtu_size > 23:
+            self.set_send_slots(VALUE_STX[0], 1024)
+        else:
+            self.set_send_slots(VALUE_SOH[0], 128)
+        self.set_block_timeout(self.block_size - 5)
+        print(f'Blocks of {self.block_size - 5} bytes in packets of {self.mtu_size - 3} bytes; timeout {self.block_timeout_ms} ms.')
+
+        self.blocks_sent = self.blocks_resent = 0
+        ticks_start = time.ticks_ms()
+        with open(filepath, 'rb') as f:
+            await self.send_file_blocks(f)
+        if not self.connection.is_connected():
+            print(f'Disconnected at block{self.seq_base - 1}.')
+            return False
+        t_ms = max(1, time.ticks_diff(time.ticks_ms(), ticks_start))
+        for _ in range(4): # The first EOT is NAKed and the second is ACKed; EOT again if the response was lost.
+            await self.send_cmd(self.rx_characteristic, VALUE_EOT)                         # Send EOT.
+            while (response := await self.wait_for_response(self.block_timeout_ms)) is not None and len(response) != 1:
+                pass # ACK of a block sent again.
+            if response == bytes(VALUE_ACK):                                               # Receive ACK.
+                break
+        else:
+            print('No ACK of EOT.')
+            return False
+        size = os.stat(filepath)[6]
+        print(f'File transmission finished: {filepath}')
+        print(f'Throughput: {size * 8 / t_ms:.1f} kbps in {t_ms} ms, {self.blocks_sent} blocks sent, {self.blocks_resent} sent again.')
+        return True
+
+    def load_peer(self, name): # {'addr_type', 'addr', 'handles'} of the last session with the device of this name, or None.
+        try:
+            with open(_PEER_CACHE) as f:
+                return json.load(f).get(name)
+        except (OSError, ValueError):
+            return None
 
+    def save_peer(self, name, device, handles):
         try:
-            print("Connecting to", device)
-            connection = await device.connect(
-                timeout_ms=60_000, 
-                scan_duration_ms=5_000, min_conn_interval_us=7_500, max_conn_interval_us=7_500)
-        except asyncio.TimeoutError:
-            print("Timeout during connection")
-            return
+            with open(_PEER_CACHE) as f:
+                peers = json.load(f)
+        except (OSError, ValueError):
+            peers = {}
+        peers[name] = {'addr_type': device.addr_type, 'addr': device.addr_hex(), 'handles': handles}
+        with open(_PEER_CACHE, 'w') as f:
+            json.dump(peers, f)
+
+    async def connect_peer(self, peer): # Directly to the address of the last session; None if not connected in time.
+        device = aioble.Device(peer['addr_type'], peer['addr'])
+        try:
+            print("Connecting directly to", device)
+            return await device.connect(
+                timeout_ms=_DIRECT_TIMEOUT_MS, min_conn_interval_us=_CONN_INTERVAL_US, max_conn_interval_us=_CONN_INTERVAL_US)
+        except (asyncio.TimeoutError, OSError):
+            print("Not connected; scanning.")
+            return None
+
+    async def subscribe(self, cccd): # subscribe(notify=True) of aioble, with the CCCD discovered or cached.
+        self.tx_characteristic._register_with_connection() # Notifications are routed to the characteristic.
+        await cccd.write(b'\x01\x00', response=True)
+
+    async def discover_handles(self, connection): # Returns the handles to be cached.
+        nus_service = await connection.service(_NUS_SERVICE_UUID)
+        # Client (Central) -> Server (Peripheral)
+        self.rx_characteristic = rx = await nus_service.characteristic(_NUS_RX_CHARACTERISTIC_UUID)
+        # Server (Peripheral) -> Client (Central)
+        self.tx_characteristic = tx = await nus_service.characteristic(_NUS_TX_CHARACTERISTIC_UUID)
+        cccd = await tx.descriptor(_CCCD_UUID)
+        await self.subscribe(cccd)
+        return [nus_service._start_handle, nus_service._end_handle, rx._end_handle, rx._value_handle, rx.properties,
+            tx._end_handle, tx._value_handle, tx.properties, cccd._value_handle]
+
+    async def attach_handles(self, connection, handles): # The characteristics from the cached handles; False if refused.
+        start, end, rx_end, rx_value, rx_properties, tx_end, tx_value, tx_properties, cccd = handles
+        nus_service = aioble.client.ClientService(connection, start, end, _NUS_SERVICE_UUID)
+        self.rx_characteristic = aioble.client.ClientCharacteristic(
+            nus_service, rx_end, rx_value, rx_properties, _NUS_RX_CHARACTERISTIC_UUID)
+        self.tx_characteristic = aioble.client.ClientCharacteristic(
+            nus_service, tx_end, tx_value, tx_properties, _NUS_TX_CHARACTERISTIC_UUID)
+        try:
+            await self.subscribe(aioble.client.ClientDescriptor(self.tx_characteristic, cccd, _CCCD_UUID))
+            return True
+        except aioble.GattError as e: # e.g. the GATT table of the server was changed.
+            print(f"Cached handles refused ({e._status}); discovering.")
+            return False
 
+    async def main(self):
+        self.conn_interval_us = _CONN_INTERVAL_US
+        self.is_conn_updated = False
+        aioble.core._irq_handlers.append(self.conn_irq_handler) # Once for each session; see on_connection_update().
+        try:
+            await self.session()
+        finally:
+            aioble.core._irq_handlers.remove(self.conn_irq_handler)
+
+    async def session(self):
+        ticks_start = time.ticks_ms()
+        peer = self.load_peer(_TARGET_NAME) if _PEER_CACHE else None
+        connection = await self.connect_peer(peer) if peer else None
+        if not connection:
+            device = await self.discover_device(_TARGET_NAME)
+            if not device:
+                print(f"{_TARGET_NAME} not found")
+                return
+
+            try:
+                print("Connecting to", device)
+                connection = await device.connect(
+                    timeout_ms=60_000, 
+                    scan_duration_ms=5_000, min_conn_interval_us=_CONN_INTERVAL_US, max_conn_interval_us=_CONN_INTERVAL_US)
+            except asyncio.TimeoutError:
+                print("Timeout during connection")
+                return
+
+        self.ticks_ready = time.ticks_ms()
+        self.conn_handle = connection._conn_handle # For the updates of the connection.
         async with connection:
             try:
-                nus_service = await connection.service(_NUS_SERVICE_UUID)
-                # Client (Central) -> Server (Peripheral)
-                self.rx_characteristic = await nus_service.characteristic(_NUS_RX_CHARACTERISTIC_UUID)
-                # Server (Peripheral) -> Client (Central)
-                self.tx_characteristic = await nus_service.characteristic(_NUS_TX_CHARACTERISTIC_UUID)
-                self.tx_characteristic._notify_queue = deque((), 7)                     # TODO: check if 7 is sufficient for STX.
-                await self.tx_characteristic.subscribe(notify=True)
+                is_cached = peer and peer['addr'] == connection.device.addr_hex() and await self.attach_handles(
+                    connection, peer['handles'])
+                if not is_cached:
+                    handles = await self.discover_handles(connection)
+                    if _PEER_CACHE: self.save_peer(_TARGET_NAME, connection.device, handles)
             except asyncio.TimeoutError:
                 print("Timeout discovering services/characteristics")
                 return
+            self.ready_ms = time.ticks_diff(time.ticks_ms(), ticks_start)
+            print(f"Ready in {self.ready_ms} ms ({'cached' if is_cached else 'discovered'}).")
 
             # Increase MTU
             await connection.exchange_mtu(mtu=209)
             self.mtu_size = connection.mtu or self.mtu_size
+            self.set_notify_queue()
+            self.connection = connection
             print(f"MTU: {self.mtu_size}")
+            if self.is_conn_updated:
+                print(f'Connection: interval {self.conn_interval_us / 1000} ms, latency {self.conn_latency}.')
+            else: # The stack does not report the parameters at connection.
+                print(f'Connection: interval {_CONN_INTERVAL_US / 1000} ms asked; not reported by the stack yet.')
 
-            await self.fetch_file()
+            if _UPLOAD:
+                await self.upload_file(_UPLOAD)
+                return
+            while await self.fetch_file(): # Files in a batch over this connection; 'C' asks for the next block zero.
+                pass
 
     def save_chunk_raw(self, data):
-        with open(f'/sd/{self.filename}', 'ab') as f:
-            return f.write(data)
+        t = time.ticks_us()
+        nbytes = self.file.write(data)
+        self.us_write += time.ticks_diff(time.ticks_us(), t)
+        return nbytes
 
     @micropython.viper
-    def crc16_arc(self, byte_array) -> int:
-        '''crc16/arc
-        XOSS uses CRC16/ARC instead of CRC16/XMODEM.
-        '''
-        crc: int = 0
-        data = ptr8(byte_array)
-        length = int(len(byte_array))
-        table = ptr16(CRC16_ARC_TBL)
+    def copy_bytes(self, dst, dst_idx: int, src, src_idx: int, n: int):
+        d = ptr8(dst)
+        s = ptr8(src)
         i: int = 0
-        while i < length:
-            crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xff]
+        while i < n:
+            d[dst_idx + i] = s[src_idx + i]
             i += 1
-        return crc
-
-CRC16_ARC_TBL = array("H", (
-    0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280, 0xC241,
-    0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481, 0x0440,
-    0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81, 0x0E40,
-    0x0A00, 0xCAC1, 0xCB81, 0x0B40, 0xC901, 0x09C0, 0x0880, 0xC841,
-    0xD801, 0x18C0, 0x1980, 0xD941, 0x1B00, 0xDBC1, 0xDA81, 0x1A40,
-    0x1E00, 0xDEC1, 0xDF81, 0x1F40, 0xDD01, 0x1DC0, 0x1C80, 0xDC41,
-    0x1400, 0xD4C1, 0xD581, 0x1540, 0xD701, 0x17C0, 0x1680, 0xD641,
-    0xD201, 0x12C0, 0x1380, 0xD341, 0x1100, 0xD1C1, 0xD081, 0x1040,
-    0xF001, 0x30C0, 0x3180, 0xF141, 0x3300, 0xF3C1, 0xF281, 0x3240,
-    0x3600, 0xF6C1, 0xF781, 0x3740, 0xF501, 0x35C0, 0x3480, 0xF441,
-    0x3C00, 0xFCC1, 0xFD81, 0x3D40, 0xFF01, 0x3FC0, 0x3E80, 0xFE41,
-    0xFA01, 0x3AC0, 0x3B80, 0xFB41, 0x3900, 0xF9C1, 0xF881, 0x3840,
-    0x2800, 0xE8C1, 0xE981, 0x2940, 0xEB01, 0x2BC0, 0x2A80, 0xEA41,
-    0xEE01, 0x2EC0, 0x2F80, 0xEF41, 0x2D00, 0xEDC1, 0xEC81, 0x2C40,
-    0xE401, 0x24C0, 0x2580, 0xE541, 0x2700, 0xE7C1, 0xE681, 0x2640,
-    0x2200, 0xE2C1, 0xE381, 0x2340, 0xE101, 0x21C0, 0x2080, 0xE041,
-    0xA001, 0x60C0, 0x6180, 0xA141, 0x6300, 0xA3C1, 0xA281, 0x6240,
-    0x6600, 0xA6C1, 0xA781, 0x6740, 0xA501, 0x65C0, 0x6480, 0xA441,
-    0x6C00, 0xACC1, 0xAD81, 0x6D40, 0xAF01, 0x6FC0, 0x6E80, 0xAE41,
-    0xAA01, 0x6AC0, 0x6B80, 0xAB41, 0x6900, 0xA9C1, 0xA881, 0x6840,
-    0x7800, 0xB8C1, 0xB981, 0x7940, 0xBB01, 0x7BC0, 0x7A80, 0xBA41,
-    0xBE01, 0x7EC0, 0x7F80, 0xBF41, 0x7D00, 0xBDC1, 0xBC81, 0x7C40,
-    0xB401, 0x74C0, 0x7580, 0xB541, 0x7700, 0xB7C1, 0xB681, 0x7640,
-    0x7200, 0xB2C1, 0xB381, 0x7340, 0xB101, 0x71C0, 0x7080, 0xB041,
-    0x5000, 0x90C1, 0x9181, 0x5140, 0x9301, 0x53C0, 0x5280, 0x9241,
-    0x9601, 0x56C0, 0x5780, 0x9741, 0x5500, 0x95C1, 0x9481, 0x5440,
-    0x9C01, 0x5CC0, 0x5D80, 0x9D41, 0x5F00, 0x9FC1, 0x9E81, 0x5E40,
-    0x5A00, 0x9AC1, 0x9B81, 0x5B40, 0x9901, 0x59C0, 0x5880, 0x9841,
-    0x8801, 0x48C0, 0x4980, 0x8941, 0x4B00, 0x8BC1, 0x8A81, 0x4A40,
-    0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80, 0x8C41,
-    0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680, 0x8641,
-    0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040,
-    ))
 
 
 def start():
@@ -384,4 +943,5 @@ def start():
         asyncio.run(client.main())
     finally:
         asyncio.new_event_loop() # Clear retained state.
+        ble_scan.shared.reset()
         machine.freq(freq)
@@ -11,10 +11,21 @@ from micropython import const
 
 import machine
 import os
+import io
 import asyncio
 import aioble
 import bluetooth
-from array import array
+import time
+from collections import deque
+from crc16_arc import crc16_arc
+try:
+    import deflate
+    _d = deflate.DeflateIO(io.BytesIO(), deflate.ZLIB)
+    _d.write(b'\x00') # Without MICROPY_PY_DEFLATE_COMPRESS (e.g. ESP32 builds), DeflateIO has no write().
+    _d.close()
+    del _d
+except Exception:
+    deflate = None
 
 _NUS_SERVICE_UUID = bluetooth.UUID("6e400001-b5a3-f393-e0a9-e50e24dcca9e")
 _NUS_RX_CHARACTERISTIC_UUID = bluetooth.UUID("6e400002-b5a3-f393-e0a9-e50e24dcca9e")
@@ -24,17 +35,97 @@ _ADV_APPEARANCE_GENERIC_COMPUTER = const(128)
 # How frequently to send advertising beacons.
 _ADV_INTERVAL_US = const(250_000)
 
+# The central sets the parameters of the connection; MicroPython does not request them from the peripheral.
+_IRQ_CONNECTION_UPDATE = const(27)
+
 VALUE_SOH = bytearray([0x01])                             # SOH == 128-byte data
 VALUE_STX = bytearray([0x02])                             # STX == 1024-byte data
+VALUE_BLK = bytearray([0x03])                             # Non-standard; data of the size negotiated in block zero
 VALUE_C = bytearray([0x43])                               # 'C'
-#VALUE_G = bytearray([0x47])                               # 'G'
+VALUE_G = bytearray([0x47])                               # 'G'
+VALUE_U = bytearray([0x55])                               # 'U'; non-standard; the client sends a file (upload)
 VALUE_ACK = bytearray([0x06])                             # ACK
 VALUE_NAK = bytearray([0x15])                             # NAK
 VALUE_EOT = bytearray([0x04])                             # EOT
 VALUE_CAN = bytearray([0x18])                             # CAN
 
+# Number of blocks in flight in the streaming ('G') mode; a power of two.
+_WINDOW = const(4)
+
+# Maximum size of data in a large block (VALUE_BLK); 0 to disable.  The ring takes (_BLOCK_MAX + 5) * (_WINDOW + 1) bytes.
+# The client chooses the size as a multiple of the ATT payload (MTU - 3) minus 5, so that no packet is short.
+_BLOCK_MAX = const(4096)
+
 ##_FILEPATH = '/sd/test.bin'
 _FILEPATH = 'test.bin'
+# Deflate (offered if available); the file is compressed by records of up to _ZCHUNK bytes, each of which is a zlib stream
+# following a 2-byte header (flags and length), so that the client decompresses one record at a time in constant memory.
+_ZCHUNK = const(4096)
+_ZWBITS = const(10) # Window of 1 KiB.
+_ZREC_DEFLATE = const(0x8000) # Otherwise stored as is, when it is not smaller.
+_ZREC_LAST = const(0x4000)
+
+# Timestamps of the phases of the last N blocks of a file, printed as histograms at the end (ticks_trace.py); 0 to disable.
+_TRACE = const(0)
+_PH_READ = const(0) # Read from the file, with CRC, in its slot of the ring.
+_PH_FIRST = const(1) # The first packet notified.
+_PH_LAST = const(2) # The last packet notified.
+_PH_ACK = const(3) # ACK received (cumulative in the streaming mode).
+if _TRACE:
+    from ticks_trace import PhaseTrace
+
+# Responses to EOT are awaited for this long, and EOT is sent again (e.g. when EOT or the response was lost).
+_EOT_TIMEOUT_MS = const(1_000)
+_EOT_RETRIES = const(4)
+
+# Send the files matching this in a batch over one connection instead, e.g. '/sd/logs' or '/sd/logs/*.csv'; None for _FILEPATH.
+_BATCH = None
+
+# Files sent by the client ('U') are saved in this directory, e.g. '/sd'; '' for the current one.
+_UPLOAD_DIR = ''
+# Data uploaded are written to the file by this many bytes (a multiple of the sector size).
+_WRITE_SIZE = const(4096)
+# Writes queued by aioble (capture) while uploading: the packets of the blocks in flight and this many more.
+_WRITE_SLACK = const(2)
+
+class DeflateReader: # Records of deflate made from the file on the fly; readinto() is used in place of that of the file.
+    def __init__(self, f):
+        self.f = f
+        self.chunk = bytearray(_ZCHUNK)
+        self.record = b''
+        self.idx = 0
+        self.is_last = False
+        self.data_raw = 0 # Bytes read from the file.
+
+    def readinto(self, buf):
+        n = 0
+        while n < len(buf):
+            if self.idx == len(self.record):
+                if self.is_last: break
+                self.next_record()
+            k = min(len(buf) - n, len(self.record) - self.idx)
+            buf[n:n + k] = self.record[self.idx:self.idx + k]
+            n += k
+            self.idx += k
+        return n
+
+    def next_record(self):
+        nbytes = self.f.readinto(self.chunk)
+        self.data_raw += nbytes
+        self.is_last = nbytes < _ZCHUNK
+        raw = memoryview(self.chunk)[:nbytes]
+        out = io.BytesIO()
+        d = deflate.DeflateIO(out, deflate.ZLIB, _ZWBITS)
+        d.write(raw)
+        d.close()
+        data = out.getvalue()
+        flags = _ZREC_LAST if self.is_last else 0
+        if len(data) < nbytes:
+            flags |= _ZREC_DEFLATE
+        else:
+            data = bytes(raw)
+        self.record = (flags | len(data)).to_bytes(2, 'big') + data
+        self.idx = 0
 
 class NUSModemServer:
     def __init__(self):
@@ -52,32 +143,85 @@ class NUSModemServer:
         )
         aioble.register_services(nus_service)
         aioble.config(mtu=512)
+        self.connection = None
+        self.conn_irq_handler = self.on_connection_update # Added to aioble in main(), and removed at the end.
+        self.conn_interval_us = 0 # Unknown, until updated.
         # **Packet**
         self.mtu_size = 23
         # **Block**
-        self.use_stx = False # True/False = STX/SOH
-        self.block_buf = bytearray(3 + 1024 + 2)                                 # Header(SOH/STX, num, ~num); data(128 or 1024 bytes); CRC16
+        self.block_type = VALUE_SOH[0] # SOH/STX/BLK
+        self.use_streaming = False # True/False = 'G'/'C'
+        self.window = _WINDOW # Number of blocks in flight, as requested by the client.
+        self.block_ring = bytearray((3 + max(1024, _BLOCK_MAX) + 2) * (_WINDOW + 1)) # Blocks in flight and the next; Header(SOH/STX/BLK, num, ~num); data; CRC16
+        self.block_slots = None # (block, data, CRC) in the ring, laid out by set_block_type().
+        self.slot = 0 # Index in block_slots.
+        self.trace = PhaseTrace(('read', 'first', 'last', 'ack'), _WINDOW + 1, _TRACE) if _TRACE else None
         self.block_num = 0 # Block number(0-255).
         #self.idx_block_buf = 0 # Index in block_buf.
-        self.mv_block_buf = memoryview(self.block_buf)
+        self.block_buf = None
+        self.mv_block_buf = None
         self.block_size = None
         self.block_data = None
         self.block_crc = None
-        self.block_size_data_crc = (
-            (3 + 128 + 2, self.mv_block_buf[3:131], self.mv_block_buf[131:133], ), # SOH
-            (3 + 1024 + 2, self.mv_block_buf[3:-2], self.mv_block_buf[-2:], ),     # STX
-        )
         # **File** A file is made of blocks; a block is made of packets.
         self.data_size = 0
         self.data_read = 0
         self.filename = ''
+        # **Streaming** Sequence numbers (1, 2, ...) of blocks; block_num == seq % 256.
+        self.seq_base = 1 # The oldest block not acknowledged yet.
+        self.seq_next = 1 # The next block to be sent.
+        self.seq_resend = [] # Blocks NAKed by the client; sent again from the ring.
+        self.seq_filled = 0 # The last block read ahead into the ring.
+        self.is_eof = False
+        # **Upload** Blocks from the client are received in order (go-back-N); the data are written through write_buf.
+        self.cmd_buf = bytearray(2) # ACK/NAK followed by a block number.
+        self.write_buf = bytearray(_WRITE_SIZE)
+        self.write_idx = 0
+        self.data_received = 0
+        self.is_next_requested = False # 'C' received in place of ACK of EOT.
+
+    def set_block_type(self, block_type, data_size):
+        self.block_type = block_type
+        self.block_size = 3 + data_size + 2
+        mv_block_ring = memoryview(self.block_ring)
+        self.block_slots = tuple(
+            (mv, mv[3:-2], mv[-2:], )
+            for mv in (mv_block_ring[i * self.block_size:(i + 1) * self.block_size] for i in range(_WINDOW + 1)))
+
+    def on_connection_update(self, event, data): # Parameters updated by either side; always passed to aioble.
+        if event == _IRQ_CONNECTION_UPDATE and self.connection is not None and data[0] == self.connection._conn_handle:
+            _, conn_interval, conn_latency, supervision_timeout, status = data
+            if status == 0:
+                self.conn_interval_us = conn_interval * 1250
+                print(f'Connection updated: interval {self.conn_interval_us / 1000} ms, latency {conn_latency}, '
+                    f'supervision timeout {supervision_timeout * 10} ms.')
 
-    def construct_block_zero(self):
+    def select_slot(self, slot):
+        self.slot = slot
+        self.mv_block_buf, self.block_data, self.block_crc = self.block_slots[slot]
+        self.block_buf = self.mv_block_buf
+
+    def filepaths(self): # Files to be sent in a session.
+        if _BATCH is None:
+            return [_FILEPATH]
+        dirname, _, pattern = _BATCH.rpartition('/') if '*' in _BATCH else (_BATCH, '', '*')
+        prefix, _, suffix = pattern.partition('*')
+        return [f'{dirname}/{name}' for name in sorted(os.listdir(dirname))
+            if name.startswith(prefix) and name.endswith(suffix) and os.stat(f'{dirname}/{name}')[0] & 0x8000] # Regular files.
+
+    def construct_block_zero(self, filepath):
         self.block_num = -1
-        self.data_size = os.stat(_FILEPATH)[6]
-        ##filename = _FILEPATH.split('/')[-1]
-        filename = _FILEPATH
-        header = bytes(f'{filename} {self.data_size}', 'utf-8')
+        header = b'' # Empty block zero; the end of the batch.
+        if filepath is not None:
+            stat = os.stat(filepath)
+            self.data_size = stat[6]
+            filename = filepath.split('/')[-1]
+            header = bytes(f'{filename} {self.data_size} G{_WINDOW}', 'utf-8') # Streaming mode with a window of N blocks is available.
+            if _BLOCK_MAX:
+                header += bytes(f' B{_BLOCK_MAX}', 'utf-8') # Large blocks of data up to N bytes are available.
+            header += bytes(f' M{stat[8]}', 'utf-8') # Modification time; the client resumes an interrupted transfer of the same file.
+            if deflate:
+                header += bytes(f' Z{_ZCHUNK}', 'utf-8') # Records of deflate of up to N bytes are available.
         self.block_data[:len(header)] = header
         self.construct_block(len(header))
 
@@ -88,24 +232,134 @@ class NUSModemServer:
             nbytes += 1
 
         self.block_num = (self.block_num + 1) % 256
-        self.block_buf[0] = VALUE_STX[0] if self.use_stx else VALUE_SOH[0]
+        self.block_buf[0] = self.block_type
         self.block_buf[1] = self.block_num
         self.block_buf[2] = 0xFF ^ self.block_num
-        self.block_crc[:] = self.crc16_arc(self.block_data).to_bytes(2, 'big')
+        self.block_crc[:] = crc16_arc(self.block_data).to_bytes(2, 'big')
 
     async def send_block(self, char, delay_ms): # Send a block through packets.
         mtu = self.mtu_size - 3
         idx = 0
         n = self.block_size - mtu
+        if self.trace: self.trace.stage(self.slot, _PH_FIRST)
         while idx < n:
-            char.notify(self.connection, self.mv_block_buf[idx:(idx := idx + mtu)])
+            await self.notify(char, self.mv_block_buf[idx:(idx := idx + mtu)])
             await asyncio.sleep_ms(0)
-        char.notify(self.connection, self.mv_block_buf[idx:self.block_size])
+        await self.notify(char, self.mv_block_buf[idx:self.block_size])
+        if self.trace: self.trace.stage(self.slot, _PH_LAST)
         await asyncio.sleep_ms(delay_ms)
 
+    async def notify(self, char, data):
+        while self.connection.is_connected():
+            try:
+                char.notify(self.connection, data)
+                return
+            except OSError: # No buffer left in the stack; this happens in the streaming mode.
+                await asyncio.sleep_ms(2)
+
+    def read_ahead(self, f, seq): # Read and construct the block in its slot in advance; True if it is ready.
+        if self.seq_filled < seq and not self.is_eof:
+            self.select_slot(seq % (self.window + 1))
+            if nbytes := f.readinto(self.block_data):
+                self.block_num = (seq - 1) % 256
+                self.construct_block(nbytes) # CRC as well.
+                if self.trace: self.trace.stage(self.slot, _PH_READ)
+                self.data_read += nbytes
+                self.seq_filled = seq
+            else:
+                self.is_eof = True
+        return self.seq_filled >= seq
+
+    async def send_file(self, f): # Stop-and-wait ('C'); wait for ACK of each block.
+        seq = 1
+        self.read_ahead(f, seq)
+        while self.connection.is_connected() and self.seq_filled >= seq:
+            while True:
+                self.select_slot(seq % (self.window + 1))
+                await self.send_block(self.tx_characteristic, delay_ms=0)
+                self.read_ahead(f, seq + 1) # While the block is on air and waiting for ACK.
+                if await self.wait_until_data(self.rx_characteristic) == bytes(VALUE_ACK):
+                    if self.trace:
+                        self.trace.stage(seq % (self.window + 1), _PH_ACK)
+                        self.trace.commit(seq % (self.window + 1))
+                    break
+            seq += 1
+
+    async def send_file_streaming(self, f): # Streaming ('G'); keep blocks in flight and resend only those NAKed.
+        self.seq_base = self.seq_next = 1
+        self.seq_resend.clear()
+        response_handler_task = asyncio.create_task(self.response_handler())
+        try:
+            while self.connection.is_connected():
+                if self.seq_resend: # The block is still in the ring.
+                    if (seq := self.seq_resend.pop(0)) >= self.seq_base:
+                        self.select_slot(seq % (self.window + 1))
+                        await self.send_block(self.tx_characteristic, delay_ms=0)
+                elif self.seq_next - self.seq_base < self.window and self.read_ahead(f, self.seq_next):
+                    self.select_slot(self.seq_next % (self.window + 1))
+                    await self.send_block(self.tx_characteristic, delay_ms=0)
+                    self.seq_next += 1
+                elif self.seq_base == self.seq_next: # All of the blocks were acknowledged.
+                    break
+                else: # Read the next block ahead while waiting for ACK.
+                    self.read_ahead(f, self.seq_next)
+                    await asyncio.sleep_ms(2)
+        finally:
+            response_handler_task.cancel()
+
+    async def response_handler(self): # ACK/NAK followed by a block number in the streaming mode.
+        _ACK = VALUE_ACK[0]
+        _NAK = VALUE_NAK[0]
+        while True:
+            data = await self.wait_until_data(self.rx_characteristic)
+            if len(data) != 2: continue
+            seq = self.seq_base + ((data[1] - self.seq_base) % 256) # Block number to sequence number.
+            if seq >= self.seq_next: continue # Stale response, or a block not sent yet.
+            if data[0] == _ACK: # Cumulative; blocks up to this were received.
+                if self.trace:
+                    for s in range(self.seq_base, seq + 1):
+                        self.trace.stage(s % (self.window + 1), _PH_ACK)
+                        self.trace.commit(s % (self.window + 1))
+                self.seq_base = seq + 1
+            elif data[0] == _NAK and seq not in self.seq_resend:
+                self.seq_resend.append(seq)
+                print(f'NAK: block{data[1]}')
+
+    async def end_of_transfer(self): # EOT, NAK, EOT and ACK; EOT again if a response does not come.  True if acknowledged.
+        is_nak_received = False
+        for _ in range(_EOT_RETRIES):
+            await self.notify(self.tx_characteristic, VALUE_EOT)                 # Send EOT.
+            response = await self.wait_for_response(_EOT_TIMEOUT_MS)
+            if response == bytes(VALUE_NAK):                                      # Receive NAK.
+                is_nak_received = True
+            elif response == bytes(VALUE_ACK) and is_nak_received:               # Receive ACK.
+                return True
+            elif response == bytes(VALUE_C) and is_nak_received: # ACK was lost; the client asks for the next block zero.
+                self.is_next_requested = True
+                return True
+        await self.connection.disconnect()
+        return False
+
+    async def wait_for_response(self, timeout_ms): # A response of one byte in timeout_ms; ACK/NAK followed by a block number,
+        ticks_end = time.ticks_add(time.ticks_ms(), timeout_ms) # sent by the client until EOT arrives, are skipped.
+        try:                                                      # None on timeout.
+            while len(data := (await self.written(max(1, time.ticks_diff(ticks_end, time.ticks_ms()))))[1]) != 1:
+                pass
+            return data
+        except asyncio.TimeoutError:
+            return None
+
+    async def written(self, timeout_ms=None): # (connection, data) from the capture queue of the RX characteristic.
+        # Not by written() of aioble, which waits on its flag with one item left; the flag may have been cleared by the wake
+        # for the previous item (e.g. NAKs of two blocks in a row), and the item would be taken only after the next wake.
+        char = self.rx_characteristic
+        while not char._write_queue:
+            await (asyncio.wait_for_ms(char._write_event.wait(), timeout_ms) if timeout_ms else char._write_event.wait())
+        return char._write_queue.popleft()
+
     async def wait_until_data(self, char, t_ms=10_000):
         try:
-            _, data = await char.written(timeout_ms=t_ms)
+            _, data = await self.written(t_ms)
             return data
         except asyncio.TimeoutError:
             print(f"Something went wrong. No new data received.")
@@ -113,6 +367,13 @@ class NUSModemServer:
             ##await self.connection.disconnect()
 
     async def main(self):
+        aioble.core._irq_handlers.append(self.conn_irq_handler) # See on_connection_update().
+        try:
+            await self.serve()
+        finally:
+            aioble.core._irq_handlers.remove(self.conn_irq_handler)
+
+    async def serve(self):
         while True:
             async with await aioble.advertise(
                 _ADV_INTERVAL_US,
@@ -122,118 +383,265 @@ class NUSModemServer:
             ) as connection:
                 print("Connection from", connection.device)
                 self.connection = connection
+                self.conn_interval_us = 0
 
                 print("Waiting for 'C'.")
-                # Receive 'C'.
-                if await self.wait_until_data(self.rx_characteristic) != bytes(VALUE_C):
+                # Receive 'C', or 'U' if the client sends a file.
+                command = await self.wait_until_data(self.rx_characteristic)
+                if command not in (bytes(VALUE_C), bytes(VALUE_U)):
                     await self.connection.disconnect()
                 else:
-                    print("'C' was received.")
+                    print(f"'{bytes(command).decode()}' was received.")
 
                 # Check MTU
                 self.mtu_size = self.connection.mtu or self.mtu_size
                 print(f"MTU: {self.mtu_size}")
 
-                # Send block number zero.  Receive ACK.
-                self.use_stx = False # Always use SOH for block zero.
-                self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.use_stx)]
-                self.construct_block_zero()
-                retries = 3
-                while retries > 0:
-                    await self.send_block(self.tx_characteristic, delay_ms=5)
-                    if await self.wait_until_data(self.rx_characteristic) == bytes(VALUE_ACK):
-                        break
-                    retries -= 1
-                if retries == 0: # Too many errors; cancel transport.
-                    print("Too many errors.")
-                    #await self.connection.disconnect()
-                    sys.exit()
-
-                # Receive 'C'.
-                if await self.wait_until_data(self.rx_characteristic) != bytes(VALUE_C):
-                    await self.connection.disconnect()
+                if command == bytes(VALUE_U):
+                    # Receive files; 'U' again for the next one.
+                    while await self.receive_file() and self.connection.is_connected() and await self.wait_for_next(VALUE_U):
+                        pass
                 else:
-                    print("The second 'C' was received.")
-
-                # Send blocks of number >= 1
-                self.use_stx = True if self.mtu_size > 23 else False
-                self.block_size, self.block_data, self.block_crc = self.block_size_data_crc[int(self.use_stx)]
-                self.data_read = 0
-                with open(_FILEPATH, 'rb') as f:
-                    while self.connection.is_connected():
-                        if (nbytes := f.readinto(self.block_data)):
-                            self.construct_block(nbytes)
-                            self.data_read += nbytes
-                            while True:
-                                await self.send_block(self.tx_characteristic, delay_ms=5)
-                                if await self.wait_until_data(self.rx_characteristic) == bytes(VALUE_ACK):
-                                    break
-                        else:
-                            # Send EOT
-                            self.tx_characteristic.notify(self.connection, VALUE_EOT)
-                            # Receive NAK
-                            if await self.wait_until_data(self.rx_characteristic) != bytes(VALUE_NAK):
-                                await self.connection.disconnect()
-                            # Send EOT
-                            self.tx_characteristic.notify(self.connection, VALUE_EOT)
-                            # Receive ACK
-                            if await self.wait_until_data(self.rx_characteristic) != bytes(VALUE_ACK):
-                                await self.connection.disconnect()
-                            print('File transmission finished.')
-                            print(f'File size: {self.data_size}.  Transmitted size: {self.data_read}.')
-                            await self.connection.disconnect()
+                    # Send the files in a batch; an empty block zero ends it.
+                    for filepath in self.filepaths() + [None]:
+                        await self.send_block_zero(filepath)
+                        if filepath is None: break
+                        await self.transfer_file(filepath)
+                        if not self.connection.is_connected() or not await self.wait_for_next():
+                            break
+                if self.connection.is_connected():
+                    await self.connection.disconnect()
                 print("Disconnected.")
                 self.mtu_size = 23
 
-    @micropython.viper
-    def crc16_arc(self, byte_array) -> int:
-        '''crc16/arc
-        XOSS uses CRC16/ARC instead of CRC16/XMODEM.
-        '''
-        crc: int = 0
-        data = ptr8(byte_array)
-        length = int(len(byte_array))
-        table = ptr16(CRC16_ARC_TBL)
-        i: int = 0
-        while i < length:
-            crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xff]
-            i += 1
-        return crc
-
-CRC16_ARC_TBL = array("H", (
-    0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280, 0xC241,
-    0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481, 0x0440,
-    0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81, 0x0E40,
-    0x0A00, 0xCAC1, 0xCB81, 0x0B40, 0xC901, 0x09C0, 0x0880, 0xC841,
-    0xD801, 0x18C0, 0x1980, 0xD941, 0x1B00, 0xDBC1, 0xDA81, 0x1A40,
-    0x1E00, 0xDEC1, 0xDF81, 0x1F40, 0xDD01, 0x1DC0, 0x1C80, 0xDC41,
-    0x1400, 0xD4C1, 0xD581, 0x1540, 0xD701, 0x17C0, 0x1680, 0xD641,
-    0xD201, 0x12C0, 0x1380, 0xD341, 0x1100, 0xD1C1, 0xD081, 0x1040,
-    0xF001, 0x30C0, 0x3180, 0xF141, 0x3300, 0xF3C1, 0xF281, 0x3240,
-    0x3600, 0xF6C1, 0xF781, 0x3740, 0xF501, 0x35C0, 0x3480, 0xF441,
-    0x3C00, 0xFCC1, 0xFD81, 0x3D40, 0xFF01, 0x3FC0, 0x3E80, 0xFE41,
-    0xFA01, 0x3AC0, 0x3B80, 0xFB41, 0x3900, 0xF9C1, 0xF881, 0x3840,
-    0x2800, 0xE8C1, 0xE981, 0x2940, 0xEB01, 0x2BC0, 0x2A80, 0xEA41,
-    0xEE01, 0x2EC0, 0x2F80, 0xEF41, 0x2D00, 0xEDC1, 0xEC81, 0x2C40,
-    0xE401, 0x24C0, 0x2580, 0xE541, 0x2700, 0xE7C1, 0xE681, 0x2640,
-    0x2200, 0xE2C1, 0xE381, 0x2340, 0xE101, 0x21C0, 0x2080, 0xE041,
-    0xA001, 0x60C0, 0x6180, 0xA141, 0x6300, 0xA3C1, 0xA281, 0x6240,
-    0x6600, 0xA6C1, 0xA781, 0x6740, 0xA501, 0x65C0, 0x6480, 0xA441,
-    0x6C00, 0xACC1, 0xAD81, 0x6D40, 0xAF01, 0x6FC0, 0x6E80, 0xAE41,
-    0xAA01, 0x6AC0, 0x6B80, 0xAB41, 0x6900, 0xA9C1, 0xA881, 0x6840,
-    0x7800, 0xB8C1, 0xB981, 0x7940, 0xBB01, 0x7BC0, 0x7A80, 0xBA41,
-    0xBE01, 0x7EC0, 0x7F80, 0xBF41, 0x7D00, 0xBDC1, 0xBC81, 0x7C40,
-    0xB401, 0x74C0, 0x7580, 0xB541, 0x7700, 0xB7C1, 0xB681, 0x7640,
-    0x7200, 0xB2C1, 0xB381, 0x7340, 0xB101, 0x71C0, 0x7080, 0xB041,
-    0x5000, 0x90C1, 0x9181, 0x5140, 0x9301, 0x53C0, 0x5280, 0x9241,
-    0x9601, 0x56C0, 0x5780, 0x9741, 0x5500, 0x95C1, 0x9481, 0x5440,
-    0x9C01, 0x5CC0, 0x5D80, 0x9D41, 0x5F00, 0x9FC1, 0x9E81, 0x5E40,
-    0x5A00, 0x9AC1, 0x9B81, 0x5B40, 0x9901, 0x59C0, 0x5880, 0x9841,
-    0x8801, 0x48C0, 0x4980, 0x8941, 0x4B00, 0x8BC1, 0x8A81, 0x4A40,
-    0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80, 0x8C41,
-    0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680, 0x8641,
-    0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040,
-    ))
+    async def send_block_zero(self, filepath):
+        # Send block number zero.  Receive ACK.
+        self.set_block_type(VALUE_SOH[0], 128) # Always use SOH for block zero.
+        self.select_slot(0)
+        self.construct_block_zero(filepath)
+        retries = 3
+        while retries > 0:
+            await self.send_block(self.tx_characteristic, delay_ms=0)
+            if await self.wait_until_data(self.rx_characteristic) == bytes(VALUE_ACK):
+                break
+            retries -= 1
+        if retries == 0: # Too many errors; cancel transport.
+            print("Too many errors.")
+            #await self.connection.disconnect()
+            sys.exit()
+
+    async def transfer_file(self, filepath):
+        # Receive 'C' (stop-and-wait) or 'G' followed by a window (streaming), and optionally B and the size of large blocks,
+        # R and the offset to resume from, and Z for deflate.
+        data = await self.wait_until_data(self.rx_characteristic)
+        if data[:1] not in (bytes(VALUE_C), bytes(VALUE_G)):
+            await self.connection.disconnect()
+        else:
+            print(f"The second '{bytes(data).decode()}' was received.")
+        self.use_streaming = data[:1] == bytes(VALUE_G)
+        self.window = _WINDOW if self.use_streaming else 1
+        large_size = 0
+        offset = 0
+        use_deflate = False
+        for option in data[1:].decode().split():
+            if option[0] == 'B':
+                large_size = int(option[1:])
+            elif option[0] == 'R':
+                offset = min(int(option[1:]), self.data_size)
+            elif option[0] == 'Z':
+                use_deflate = deflate is not None
+            elif self.use_streaming:
+                self.window = min(int(option), _WINDOW)
+
+        # Send blocks of number >= 1
+        if 0 < large_size <= _BLOCK_MAX:
+            self.set_block_type(VALUE_BLK[0], large_size)
+        elif self.mtu_size > 23:
+            self.set_block_type(VALUE_STX[0], 1024)
+        else:
+            self.set_block_type(VALUE_SOH[0], 128)
+        print(f'Blocks of {self.block_size - 5} bytes in packets of {self.mtu_size - 3} bytes; interval '
+            + (f'{self.conn_interval_us / 1000} ms.' if self.conn_interval_us else 'as set by the central.'))
+        self.data_read = 0
+        self.seq_filled = 0
+        self.is_eof = False
+        if self.trace: self.trace.reset()
+        with open(filepath, 'rb') as f:
+            if offset:
+                f.seek(offset)
+                print(f'Resume from {offset}.')
+            reader = DeflateReader(f) if use_deflate else f # Compressed between readinto() and construct_block().
+            if self.use_streaming:
+                await self.send_file_streaming(reader)
+            else:
+                await self.send_file(reader)
+        if self.connection.is_connected() and await self.end_of_transfer():
+            print(f'File transmission finished: {filepath}')
+            print(f'File size: {self.data_size}.  Transmitted size: {self.data_read}'
+                + (f' (deflate of {reader.data_raw}).' if use_deflate else '.'))
+            if self.trace: self.trace.dump()
+
+    async def wait_for_next(self, value=VALUE_C): # Receive 'C' for the next block zero; a client without batch does not send it.
+        if self.is_next_requested: # Received in place of ACK of EOT.
+            self.is_next_requested = False
+            return True
+        try:
+            _, data = await self.written(3_000)
+            return data == bytes(value)
+        except asyncio.TimeoutError:
+            return False
+
+    async def receive_block(self, timeout_ms=10_000): # Combine the packets written by the client into a block in the slot.
+        idx = 0 # True if received, False on EOT, or None on timeout.
+        while True:
+            try:
+                _, data = await self.written(timeout_ms)
+            except asyncio.TimeoutError:
+                return None
+            if idx == 0:
+                if len(data) == 1 and data[0] == VALUE_EOT[0]:
+                    return False
+                if len(data) < 3 or data[0] != self.block_type or data[1] ^ data[2] != 0xFF:
+                    continue # Not the first packet of a block; the rest of a block after a lost packet.
+            n = min(len(data), self.block_size - idx)
+            self.mv_block_buf[idx:idx + n] = memoryview(data)[:n]
+            idx += n
+            if idx == self.block_size:
+                return True
+
+    def is_block_valid(self):
+        return crc16_arc(self.block_data) == int.from_bytes(self.block_crc, 'big')
+
+    async def respond(self, value, num): # ACK/NAK followed by a block number.
+        self.cmd_buf[0] = value[0]
+        self.cmd_buf[1] = num
+        await self.notify(self.tx_characteristic, self.cmd_buf)
+
+    def choose_large_size(self, size_max): # As the client does for downloads; a multiple of the ATT payload minus 5.
+        payload = self.mtu_size - 3
+        n_packets = (min(size_max, _BLOCK_MAX) + 5) // payload
+        size = n_packets * payload - 5
+        n_packets_stx = (3 + 1024 + 2 + payload - 1) // payload
+        return size if _BLOCK_MAX and self.mtu_size > 23 and size * n_packets_stx > 1024 * n_packets else 0
+
+    def set_write_queue(self): # Deep enough for the blocks in flight; see _WRITE_SLACK.
+        payload = self.mtu_size - 3
+        depth = self.window * ((self.block_size + payload - 1) // payload) + _WRITE_SLACK
+        self.rx_characteristic._write_queue = deque((), depth)
+        print(f'Write queue: {depth}')
+
+    def save_data(self, f, data): # Through write_buf, by _WRITE_SIZE bytes.
+        i = 0
+        while i < len(data):
+            k = min(len(data) - i, _WRITE_SIZE - self.write_idx)
+            self.write_buf[self.write_idx:self.write_idx + k] = data[i:i + k]
+            self.write_idx += k
+            i += k
+            if self.write_idx == _WRITE_SIZE:
+                self.flush_data(f)
+
+    def flush_data(self, f):
+        f.write(memoryview(self.write_buf)[:self.write_idx])
+        self.write_idx = 0
+
+    async def receive_block_zero(self): # Name, size and options of the file; retried on error.
+        self.set_block_type(VALUE_SOH[0], 128) # Always SOH for block zero.
+        self.select_slot(0)
+        for _ in range(3):
+            await self.notify(self.tx_characteristic, VALUE_C) # 'C' again after a packet was lost.
+            if not await self.receive_block(1_000):
+                continue
+            if self.is_block_valid() and self.block_buf[1] == 0:
+                return bytes(self.block_data).rstrip(b'\x00').decode('utf-8').split()
+            await self.notify(self.tx_characteristic, VALUE_NAK)
+        print("Too many errors.")
+        return None
+
+    async def receive_file(self): # Upload ('U'); the client sends the blocks by write without response.  True if received.
+        file_informations = await self.receive_block_zero()
+        if not file_informations:
+            return False
+        filename = file_informations[0].split('/')[-1]
+        self.data_size = int(file_informations[1])
+        self.use_streaming = False
+        self.window = 1
+        large_max = 0
+        for option in file_informations[2:]:
+            if option[0] == 'G': # Streaming mode; the client keeps up to N blocks in flight.
+                self.use_streaming = True
+                self.window = min(int(option[1:]), _WINDOW)
+            elif option[0] == 'B': # Large blocks of data up to N bytes are available.
+                large_max = int(option[1:])
+        # The client chooses in downloads; here the server does, and answers as the client would.
+        if large_size := self.choose_large_size(large_max) if large_max else 0:
+            self.set_block_type(VALUE_BLK[0], large_size)
+        elif self.mtu_size > 23:
+            self.set_block_type(VALUE_STX[0], 1024)
+        else:
+            self.set_block_type(VALUE_SOH[0], 128)
+        self.select_slot(0)
+        self.set_write_queue()
+        filepath = f'{_UPLOAD_DIR}/{filename}' if _UPLOAD_DIR else filename
+        reply = f'G{self.window}' if self.use_streaming else 'C'
+        reply += f' B{large_size}' if large_size else ''
+        print(f'Receiving {filepath} ({self.data_size} bytes) in blocks of {self.block_size - 5} bytes; {reply}')
+
+        self.block_num = 0
+        self.data_received = 0
+        self.write_idx = 0
+        n_ack = max(1, self.window // 2) # Cumulative ACK every window/2 blocks, and at the end of the file.
+        acks_pending = 0
+        is_nak_sent = False
+        nak_ahead = 0 # Of the last block after NAK.
+        eot_received = 0
+        with open(filepath, 'wb') as f:
+            await self.notify(self.tx_characteristic, VALUE_ACK) # ACK of block zero,
+            await self.notify(self.tx_characteristic, bytes(reply, 'utf-8')) # and 'G' or 'C', as the client does.
+            ticks_start = ticks_end = time.ticks_ms()
+            replies = 3 # Sent again until the first block arrives, as the reply may be lost.
+            while self.connection.is_connected():
+                is_first = self.data_received == 0 and replies > 0
+                if (received := await self.receive_block(1_000 if is_first else 10_000)) is None:
+                    if is_first:
+                        replies -= 1
+                        await self.notify(self.tx_characteristic, bytes(reply, 'utf-8'))
+                        continue
+                    print("Something went wrong. No new data received.")
+                    break
+                if not received: # EOT; NAK the first one and ACK the second, as the client does.
+                    if self.data_received < self.data_size: continue
+                    eot_received += 1
+                    await self.notify(self.tx_characteristic, VALUE_NAK if eot_received == 1 else VALUE_ACK)
+                    if eot_received == 2: break
+                    continue
+                ahead = (self.block_buf[1] - self.block_num - 1) % 256
+                is_valid = self.is_block_valid()
+                if ahead >= 128: # Sent again after ACK was lost, or after NAK; the last one received is acknowledged.
+                    if is_valid: await self.respond(VALUE_ACK, self.block_num)
+                elif ahead or not is_valid: # After a block lost, or broken; the client goes back to the missing one.
+                    if not is_nak_sent or ahead <= nak_ahead: # Once, and again if the client went back and lost it again.
+                        is_nak_sent = True
+                        await self.respond(VALUE_NAK, (self.block_num + 1) % 256)
+                    nak_ahead = ahead
+                else:
+                    n = min(self.block_size - 5, self.data_size - self.data_received) # Remove padded zeros at the end.
+                    self.save_data(f, self.block_data[:n])
+                    self.data_received += n
+                    self.block_num = self.block_buf[1]
+                    is_nak_sent = False
+                    acks_pending += 1
+                    if acks_pending >= n_ack or self.data_received >= self.data_size:
+                        acks_pending = 0
+                        await self.respond(VALUE_ACK, self.block_num)
+                        if self.data_received >= self.data_size: ticks_end = time.ticks_ms()
+            self.flush_data(f)
+        if eot_received < 2:
+            print(f'Disconnected at {self.data_received}.')
+            return False
+        t_ms = max(1, time.ticks_diff(ticks_end, ticks_start))
+        print(f'File reception finished: {filepath}')
+        print(f'Throughput: {self.data_received * 8 / t_ms:.1f} kbps in {t_ms} ms.')
+        return True
 
 def start():
     #freq = machine.freq()
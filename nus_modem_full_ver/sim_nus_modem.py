@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#coding:utf-8
+#
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/micropython_aioble_examples
+#
+# Transfer a file from nus_modem_server.py to nus_modem_client.py (or the other way, --direction up) over the simulated
+# link of aioble_sim.py.
+# e.g. python sim_nus_modem.py --mtu 209 --interval 7.5 --loss 0.01 --size 100000
+
+import sys
+import os
+import argparse
+import asyncio
+import random
+import tempfile
+import shutil
+import time
+import re
+import json
+
+import aioble_sim
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the YMODEM/NUS modem pair over a simulated BLE link.')
+    parser.add_argument('--direction', choices=('down', 'up'), default='down',
+                        help='from the server to the client, or from the client to the server (_UPLOAD)')
+    parser.add_argument('--mtu', type=int, default=209, help='MTU of the link (23 for SOH blocks)')
+    parser.add_argument('--interval', type=float, default=None, help='connection interval in ms (default: as asked)')
+    parser.add_argument('--packets', type=int, default=6, help='packets per connection event')
+    parser.add_argument('--queue', type=int, default=64, help='depth of the queues of notifications and writes in the controllers')
+    parser.add_argument('--loss', type=float, default=0.0, help='rate of notifications lost')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--size', type=int, default=50_000, help='size of the random file to send')
+    parser.add_argument('--file', help='send this file instead of a random one')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='connect this many times in turn; the later ones use the peer cache of the first (_PEER_CACHE)')
+    parser.add_argument('--timeout', type=float, default=600, help='in seconds of the simulated time')
+    parser.add_argument('--mode', choices=('g', 'c'), default='g', help="streaming ('G') or stop-and-wait ('C')")
+    parser.add_argument('--blocks', choices=('large', 'std'), default='large', help='allow large blocks, or SOH/STX only')
+    parser.add_argument('--trace', type=int, default=0, help='trace the phases of the last N blocks (ticks_trace.py)')
+    parser.add_argument('--quiet', action='store_true', help='suppress the output of the client and the server')
+    parser.add_argument('--json', action='store_true', help='print the results as a line of JSON')
+    return parser.parse_args(argv)
+
+
+def simulate(args):
+    """Run a transfer; returns a dict of the results."""
+    work = tempfile.mkdtemp(prefix='nus_modem_sim_')
+    src_dir = os.path.join(work, 'src') # The current directory of the server.
+    sd_dir = os.path.join(work, 'sd') # /sd of the client.
+    os.mkdir(src_dir)
+    os.mkdir(sd_dir)
+    upload = args.direction == 'up'
+    src = os.path.join(sd_dir if upload else src_dir, 'test.bin')
+    if args.file:
+        shutil.copyfile(args.file, src)
+    else:
+        rng = random.Random(args.seed)
+        with open(src, 'wb') as f:
+            f.write(rng.randbytes(args.size))
+    size = os.path.getsize(src)
+
+    aioble_sim.install(aioble_sim.LinkParams(
+        mtu=args.mtu, conn_interval_ms=args.interval, packets_per_event=args.packets,
+        tx_buffers=args.queue, loss=args.loss, seed=args.seed), sd_dir=sd_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # ble_scan.py
+    cwd = os.getcwd()
+    os.chdir(src_dir)
+    stdout = sys.stdout
+    if args.quiet:
+        sys.stdout = open(os.devnull, 'w')
+    import nus_modem_server
+    import nus_modem_client
+    configure(args, nus_modem_server, nus_modem_client)
+
+    async def transfer():
+        server = nus_modem_server.NUSModemServer()
+        server_task = asyncio.create_task(server.main())
+        await asyncio.sleep(0.5) # Advertising.
+        ready_ms = []
+        try:
+            for _ in range(args.sessions): # The results are of the last one.
+                client = nus_modem_client.NUSModemClient()
+                counts.update(sent=0, t_first=None, t_end=None)
+                t0 = asyncio.get_event_loop().time()
+                await asyncio.wait_for(client.main(), args.timeout)
+                ready_ms.append(client.ready_ms)
+                await asyncio.sleep(0.1) # The server advertises again.
+        finally:
+            server_task.cancel()
+        client.ready_ms_sessions = ready_ms
+        return asyncio.get_event_loop().time() - t0 - 0.1, client
+
+    cpu = time.process_time()
+    try:
+        elapsed, client = aioble_sim.run(transfer)
+        error = None
+    except (Exception, SystemExit) as e: # The server calls sys.exit() on a timeout.
+        elapsed, client, error = None, None, repr(e)
+    finally:
+        cpu = time.process_time() - cpu
+        if args.quiet:
+            sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+    received = os.path.join(src_dir if upload else sd_dir, 'test.bin')
+    with open(src, 'rb') as f_src:
+        ok = os.path.exists(received) and open(received, 'rb').read() == f_src.read()
+    shutil.rmtree(work)
+    stats = aioble_sim.stats
+    n_blocks = getattr(client, 'blocks_saved', 0)
+    if upload:
+        n_blocks = client.blocks_sent - client.blocks_resent if client else 0
+    t_data = counts['t_end'] - counts['t_first'] if counts['t_first'] is not None and counts['t_end'] else None
+    return {
+        'ok': ok, 'error': error, 'size': size, 'elapsed': elapsed, 'cpu': cpu,
+        'kbps': size * 8 / elapsed / 1000 if ok and elapsed else 0.0,
+        'data_kbps': size * 8 / t_data / 1000 if ok and t_data else 0.0, # From the first block to the end of transfer.
+        'mtu': getattr(client, 'mtu_size', None), 'block_size': counts['block_size'],
+        'n_blocks': n_blocks, 'resent': max(0, counts['sent'] - n_blocks),
+        'cpu_per_block': cpu / n_blocks if n_blocks else None,
+        'events': stats.events, 'notified': stats.notified, 'dropped': stats.dropped,
+        'written': stats.written, 'tx_full': stats.tx_full, 'notify_dropped': getattr(client, 'notify_dropped', None),
+        'write_dropped': stats.write_dropped, 'first_block_ms': getattr(client, 'first_block_ms', None),
+        'ready_ms': getattr(client, 'ready_ms_sessions', None),
+    }
+
+
+counts = {}
+
+
+def configure(args, server_module, client_module):
+    """Set the server and the client as the options, as editing their constants would do on the devices."""
+    counts.update(sent=0, block_size=0, t_first=None, t_end=None, in_transfer=False)
+    if args.trace:
+        from ticks_trace import PhaseTrace
+        for module in (server_module, client_module):
+            module._TRACE = args.trace
+            module.PhaseTrace = PhaseTrace
+    server = server_module.NUSModemServer
+    if args.blocks == 'std':
+        server_module._BLOCK_MAX = 0
+
+    if args.direction == 'up':
+        configure_upload(args, server_module, client_module)
+        return
+
+    if args.mode == 'c': # Without the G token in block zero, as the server in the parent directory.
+        construct_block_zero = server.construct_block_zero
+
+        def construct_block_zero_c(self, filepath):
+            construct_block_zero(self, filepath)
+            header = re.sub(rb' G\d+', b'', bytes(self.block_data).rstrip(b'\x00'))
+            self.block_num = -1
+            self.block_data[:len(header)] = header
+            self.construct_block(len(header))
+        server.construct_block_zero = construct_block_zero_c
+
+    send_block = server.send_block
+
+    async def send_block_counted(self, *args, **kwargs): # Blocks of number >= 1, including those sent again.
+        if counts['in_transfer']:
+            counts['sent'] += 1
+            counts['block_size'] = self.block_size - 5
+            if counts['t_first'] is None:
+                counts['t_first'] = asyncio.get_event_loop().time()
+        return await send_block(self, *args, **kwargs)
+    server.send_block = send_block_counted
+
+    transfer_file = server.transfer_file
+
+    async def transfer_file_counted(self, filepath): # Until the second EOT is acknowledged.
+        counts['in_transfer'] = True
+        try:
+            return await transfer_file(self, filepath)
+        finally:
+            counts['in_transfer'] = False
+            counts['t_end'] = asyncio.get_event_loop().time()
+    server.transfer_file = transfer_file_counted
+
+    configure_mtu(args)
+
+
+def configure_mtu(args):
+    exchange_mtu = sys.modules['aioble'].DeviceConnection.exchange_mtu
+
+    async def exchange_mtu_as_link(self, mtu=None, timeout_ms=1_000): # Instead of 209 asked by the client.
+        return await exchange_mtu(self, mtu=args.mtu, timeout_ms=timeout_ms)
+    sys.modules['aioble'].DeviceConnection.exchange_mtu = exchange_mtu_as_link
+
+
+def configure_upload(args, server_module, client_module):
+    client_module._UPLOAD = '/sd/test.bin'
+    client = client_module.NUSModemClient
+
+    if args.mode == 'c': # Without the G token in block zero; the server answers 'C'.
+        upload_header = client.upload_header
+
+        def upload_header_c(self, filepath):
+            return re.sub(rb' G\d+', b'', upload_header(self, filepath))
+        client.upload_header = upload_header_c
+
+    write_block = client.write_block
+
+    async def write_block_counted(self, block):
+        if counts['in_transfer']:
+            counts['sent'] += 1
+            counts['block_size'] = self.block_size - 5
+            if counts['t_first'] is None:
+                counts['t_first'] = asyncio.get_event_loop().time()
+        return await write_block(self, block)
+    client.write_block = write_block_counted
+
+    send_file_blocks = client.send_file_blocks
+
+    async def send_file_blocks_counted(self, f):
+        counts['in_transfer'] = True
+        return await send_file_blocks(self, f)
+    client.send_file_blocks = send_file_blocks_counted
+
+    upload_file = client.upload_file
+
+    async def upload_file_counted(self, filepath): # Until the second EOT is acknowledged.
+        try:
+            return await upload_file(self, filepath)
+        finally:
+            counts['in_transfer'] = False
+            counts['t_end'] = asyncio.get_event_loop().time()
+    client.upload_file = upload_file_counted
+    configure_mtu(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = simulate(args)
+    if args.json:
+        print(json.dumps(result))
+        sys.exit(0 if result['ok'] else 1)
+    print(('OK' if result['ok'] else 'FAILED') + (f" {result['error']}" if result['error'] else ''))
+    print(f"{result['size']} bytes in {result['elapsed'] or 0:.3f} s (simulated), {result['kbps']:.1f} kbps "
+          f"({result['data_kbps']:.1f} kbps in the data phase), "
+          f"MTU {result['mtu']}, {result['n_blocks']} blocks of {result['block_size']} bytes, {result['resent']} resent, "
+          f"{result['events']} events, {result['notified']} notified, "
+          f"{result['dropped']} lost, {result['notify_dropped']} dropped by the client, {result['written']} written, "
+          f"{result['write_dropped']} dropped by the server, first block {result['first_block_ms']} ms after connected, "
+          f"ready in {result['ready_ms']} ms, "
+          f"cpu {result['cpu']:.2f} s")
+    sys.exit(0 if result['ok'] else 1)
@@ -0,0 +1,66 @@
+# (c) 2024-2025 ekspla.
+# MIT License.  https://github.com/ekspla/micropython_aioble_examples
+#
+# Timestamps (ticks_us) of the phases of each block in a transfer, for the clients and the server of YMODEM/Nordic UART Service.
+#
+# The phases of a block in flight are staged by its slot (stage(slot, phase)), moved to a ring of the last n blocks when the
+# block is done with its slot (commit(slot)), and the later phases are marked on that entry (mark(phase)).  All of the
+# buffers are allocated in advance; nothing is allocated until dump(), which prints the histograms of the time between
+# successive phases.
+
+import time
+from array import array
+
+class PhaseTrace:
+    def __init__(self, names, n_slots, n_blocks=256):
+        self.names = names # Names of the phases in the order of time; up to 8.
+        self.n_phases = n_phases = len(names)
+        self.n_slots = n_slots
+        self.n_blocks = n_blocks
+        self.stage_ticks = array('i', bytes(4 * n_phases * n_slots)) # Blocks in flight, by the slot.
+        self.stage_marked = bytearray(n_slots) # Bits of the phases marked.
+        self.ticks = array('i', bytes(4 * n_phases * n_blocks)) # Ring of the blocks committed.
+        self.marked = bytearray(n_blocks)
+        self.count = 0 # Blocks committed.
+        self.entry = 0 # Index of the last one in the ring.
+
+    def reset(self):
+        self.stage_marked[:] = bytes(self.n_slots)
+        self.count = 0
+
+    def stage(self, slot, phase):
+        self.stage_ticks[slot * self.n_phases + phase] = time.ticks_us()
+        self.stage_marked[slot] |= 1 << phase
+
+    def commit(self, slot):
+        n = self.n_phases
+        self.entry = entry = self.count % self.n_blocks
+        i = entry * n
+        j = slot * n
+        for k in range(n):
+            self.ticks[i + k] = self.stage_ticks[j + k]
+        self.marked[entry] = self.stage_marked[slot]
+        self.stage_marked[slot] = 0
+        self.count += 1
+
+    def mark(self, phase):
+        self.ticks[self.entry * self.n_phases + phase] = time.ticks_us()
+        self.marked[self.entry] |= 1 << phase
+
+    def dump(self):
+        n_blocks = min(self.count, self.n_blocks)
+        print(f'Phases of the last {n_blocks} of {self.count} blocks; us (histogram by powers of two):')
+        n = self.n_phases
+        for k in range(1, n + (n > 2)):
+            a, b = (0, n - 1) if k == n else (k - 1, k) # The successive phases, and then the first to the last.
+            bits = 1 << a | 1 << b
+            us = sorted(time.ticks_diff(self.ticks[i * n + b], self.ticks[i * n + a])
+                for i in range(n_blocks) if self.marked[i] & bits == bits)
+            if not us: continue
+            histogram = {}
+            for t in us:
+                le = 1
+                while le < t: le <<= 1
+                histogram[le] = histogram.get(le, 0) + 1
+            print(f'  {self.names[a]}->{self.names[b]}: n={len(us)} min={us[0]} median={us[len(us) // 2]} max={us[-1]}  '
+                + ' '.join(f'<={le}:{histogram[le]}' for le in sorted(histogram)))